@@ -0,0 +1,218 @@
+#
+#  osm2spatialite
+#  Copyright (C) 2011 Daniel Sabo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import collections
+
+# Rough per entry memory use in bytes, used when the capacity is given in MB
+POINT_SIZE  = 200
+OBJECT_SIZE = 500
+REF_SIZE    = 40
+TAG_SIZE    = 150
+
+def estimateSize(kind, value):
+    """Guess how many bytes a cached value takes up"""
+    if kind == "p":
+        return POINT_SIZE
+    size = OBJECT_SIZE + TAG_SIZE * len(value.tags)
+    if kind == "w":
+        size += REF_SIZE * len(value.nodes)
+    elif kind == "r":
+        size += REF_SIZE * len(value.members)
+    return size
+
+class LRUCache():
+    """A least recently used cache bounded by a number of entries and/or
+    an (estimated) number of bytes"""
+    def __init__(self, maxEntries=None, maxBytes=None):
+        self.entries = collections.OrderedDict()
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the cached value or None, a hit makes the entry the most recently used"""
+        try:
+            entry = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, size=0):
+        self.discard(key)
+        self.entries[key] = (value, size)
+        self.bytes += size
+
+        while (self.maxEntries is not None and len(self.entries) > self.maxEntries) or \
+              (self.maxBytes is not None and self.bytes > self.maxBytes):
+            self.bytes -= self.entries.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+class OSMCachedStore():
+    """A read-through cache in front of another (usually disk backed)
+    datastore. Decoded nodes, ways, relations and node locations that
+    were looked up are kept in an LRU cache, adding or deleting objects
+    invalidates them."""
+    def __init__(self, datastore, maxEntries=None, maxMB=None):
+        """maxEntries: Maximum number of cached objects and node locations
+        maxMB: Maximum estimated memory use of the cache in MB"""
+        self.datastore = datastore
+        self.measure = maxMB is not None
+        maxBytes = None
+        if maxMB is not None:
+            maxBytes = maxMB * 1024 * 1024
+        self.cache = LRUCache(maxEntries, maxBytes)
+
+    def commit(self):
+        self.datastore.commit()
+
+    def cleanup(self):
+        self.cache.clear()
+        self.datastore.cleanup()
+
+    def getStats(self):
+        """Return a dict of cache counters"""
+        return {"entries":len(self.cache), "bytes":self.cache.bytes,
+                "hits":self.cache.hits, "misses":self.cache.misses, "evictions":self.cache.evictions}
+
+    def _put(self, kind, osm_id, value):
+        if self.measure:
+            self.cache.put((kind, osm_id), value, estimateSize(kind, value))
+        else:
+            self.cache.put((kind, osm_id), value)
+
+    def _get(self, kind, osm_id, fetch):
+        value = self.cache.get((kind, osm_id))
+        if value is None:
+            value = fetch(osm_id)
+            if value is not None:
+                self._put(kind, osm_id, value)
+        return value
+
+    def _getMany(self, kind, osm_ids, fetch):
+        result = {}
+        missing = []
+        for osm_id in osm_ids:
+            value = self.cache.get((kind, osm_id))
+            if value is None:
+                missing.append(osm_id)
+            else:
+                result[osm_id] = value
+        if missing:
+            for osm_id,value in fetch(missing).iteritems():
+                if value is not None:
+                    self._put(kind, osm_id, value)
+                    result[osm_id] = value
+        return result
+
+    # "Add" functions
+    def addNode(self, object):
+        self.cache.discard(("n", object.id))
+        self.cache.discard(("p", object.id))
+        self.datastore.addNode(object)
+
+    def addNodeBlock(self, ids, lons, lats, tags):
+        if len(self.cache):
+            for osm_id in ids:
+                self.cache.discard(("n", osm_id))
+                self.cache.discard(("p", osm_id))
+        self.datastore.addNodeBlock(ids, lons, lats, tags)
+
+    def addWay(self, object):
+        self.cache.discard(("w", object.id))
+        self.datastore.addWay(object)
+
+    def addRelation(self, object):
+        self.cache.discard(("r", object.id))
+        self.datastore.addRelation(object)
+
+    # "Delete" functions
+    def delWays(self, osm_ids):
+        for osm_id in osm_ids:
+            self.cache.discard(("w", osm_id))
+        self.datastore.delWays(osm_ids)
+
+    # "Iteration" functions, these bypass the cache
+    def getNodesIter(self):
+        return self.datastore.getNodesIter()
+
+    def getWaysIter(self):
+        return self.datastore.getWaysIter()
+
+    def getRelationsIter(self):
+        return self.datastore.getRelationsIter()
+
+    # Count data length
+    def getNumNodes(self):
+        return self.datastore.getNumNodes()
+    def getNumWays(self):
+        return self.datastore.getNumWays()
+    def getNumRelations(self):
+        return self.datastore.getNumRelations()
+
+    # "Get" functions
+    def getNode(self, osm_id):
+        return self._get("n", osm_id, self.datastore.getNode)
+
+    def getNodes(self, osm_ids):
+        return self._getMany("n", osm_ids, self.datastore.getNodes)
+
+    def getNodePoints(self, osm_ids):
+        """Return the [lon, lat] of each of osm_ids, None for missing nodes"""
+        get = self.cache.get
+        points = [get(("p", osm_id)) for osm_id in osm_ids]
+        missing = [osm_id for osm_id,point in zip(osm_ids, points) if point is None]
+        if missing:
+            fetched = dict(zip(missing, self.datastore.getNodePoints(missing)))
+            for i in xrange(len(points)):
+                if points[i] is None:
+                    point = fetched[osm_ids[i]]
+                    if point is not None:
+                        self._put("p", osm_ids[i], point)
+                    points[i] = point
+        return points
+
+    def getWay(self, osm_id):
+        return self._get("w", osm_id, self.datastore.getWay)
+
+    def getWays(self, osm_ids):
+        return self._getMany("w", osm_ids, self.datastore.getWays)
+
+    def getRelation(self, osm_id):
+        return self._get("r", osm_id, self.datastore.getRelation)
+
+    def getRelations(self, osm_ids):
+        return self._getMany("r", osm_ids, self.datastore.getRelations)
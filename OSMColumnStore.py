@@ -0,0 +1,182 @@
+#
+#  osm2spatialite
+#  Copyright (C) 2011 Daniel Sabo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import array
+import bisect
+
+from OSMNodeLocationStore import SortedNodeLocations
+from OSMElements import Node, Way, idArray
+
+class OSMColumnStore():
+    """An in-memory datastore that keeps objects in typed arrays instead of
+    one dict per object:
+
+    - Node locations are kept in a SortedNodeLocations (or any other location
+      index), only tagged nodes are kept as objects.
+    - Ways are parallel arrays of ids, versions and offsets into one
+      concatenated array of node refs, tags are kept for tagged ways only.
+    - Relations are few, they are kept as objects.
+
+    Node, way and relation objects are built on the fly when they are
+    requested. Untagged nodes have a version of -1."""
+    def __init__(self, locations=None):
+        if locations is None:
+            locations = SortedNodeLocations()
+        self.locations = locations
+        self.taggedNodes = {}
+
+        self.wayIds      = idArray()
+        self.wayVersions = array.array('i')
+        # refs of way i are wayRefs[wayOffsets[i]:wayOffsets[i + 1]]
+        self.wayOffsets  = idArray([0])
+        self.wayRefs     = idArray()
+        self.wayTags     = {}
+        self.deletedWays = set()
+        # Ways are looked up by binary search while they arrive sorted by id,
+        # otherwise by a dict of id -> position that's built on demand
+        self.waysSorted  = True
+        self.wayIndex    = None
+
+        self.relations = {}
+
+    def commit(self):
+        self.locations.flush()
+
+    def cleanup(self):
+        self.locations.close()
+
+    # "Add" functions
+    def addNode(self, object):
+        lon,lat = object.point
+        self.locations.set(object.id, lon, lat)
+        if object.tags:
+            self.taggedNodes[object.id] = object
+
+    def addNodeBlock(self, ids, lons, lats, tags):
+        self.locations.setBlock(ids, lons, lats)
+        for i,nodeTags in tags.iteritems():
+            if nodeTags:
+                self.taggedNodes[int(ids[i])] = Node(int(ids[i]), (float(lons[i]), float(lats[i])), nodeTags)
+
+    def addWay(self, object):
+        osm_id = object.id
+        if self.wayIds and osm_id <= self.wayIds[-1]:
+            self.waysSorted = False
+        if self.wayIndex is not None:
+            self.wayIndex[osm_id] = len(self.wayIds)
+        self.wayIds.append(osm_id)
+        self.wayVersions.append(object.version)
+        self.wayRefs.extend(object.nodes)
+        self.wayOffsets.append(len(self.wayRefs))
+        if object.tags:
+            self.wayTags[osm_id] = object.tags
+
+    def addRelation(self, object):
+        self.relations[object.id] = object
+
+    # "Delete" functions
+    def delWays(self, osm_ids):
+        for osm_id in osm_ids:
+            if self._findWay(osm_id) is not None:
+                self.deletedWays.add(osm_id)
+
+    # "Iteration" functions, only tagged nodes are kept as objects
+    def getNodesIter(self):
+        return self.taggedNodes.itervalues()
+
+    def getWaysIter(self):
+        deletedWays = self.deletedWays
+        for i in xrange(len(self.wayIds)):
+            if self.wayIds[i] not in deletedWays:
+                yield self._makeWay(i)
+
+    def getRelationsIter(self):
+        return self.relations.itervalues()
+
+    # Count data length
+    def getNumNodes(self):
+        return len(self.locations)
+    def getNumWays(self):
+        return len(self.wayIds) - len(self.deletedWays)
+    def getNumRelations(self):
+        return len(self.relations)
+
+    # Ways
+    def _findWay(self, osm_id):
+        """Return the position of a way in the arrays, None if it isn't stored"""
+        if self.waysSorted:
+            i = bisect.bisect_left(self.wayIds, osm_id)
+            if i < len(self.wayIds) and self.wayIds[i] == osm_id:
+                return i
+            return None
+        if self.wayIndex is None:
+            self.wayIndex = dict((osm_id, i) for i,osm_id in enumerate(self.wayIds))
+        return self.wayIndex.get(osm_id)
+
+    def _makeWay(self, i):
+        osm_id = self.wayIds[i]
+        refs = self.wayRefs[self.wayOffsets[i]:self.wayOffsets[i + 1]]
+        return Way(osm_id, refs, self.wayTags.get(osm_id, {}), self.wayVersions[i])
+
+    # "Get" functions
+    def getNode(self, osm_id):
+        node = self.taggedNodes.get(osm_id)
+        if node is None:
+            point = self.locations.get(osm_id)
+            if point is not None:
+                node = Node(osm_id, tuple(point), {})
+        return node
+
+    def getNodes(self, osm_ids):
+        result = {}
+        for osm_id in osm_ids:
+            node = self.getNode(osm_id)
+            if node is not None:
+                result[osm_id] = node
+        return result
+
+    def getNodePoints(self, osm_ids):
+        """Return the [lon, lat] of each of osm_ids, None for missing nodes"""
+        return self.locations.getMany(osm_ids)
+
+    def getWay(self, osm_id):
+        if osm_id in self.deletedWays:
+            return None
+        i = self._findWay(osm_id)
+        if i is None:
+            return None
+        return self._makeWay(i)
+
+    def getWays(self, osm_ids):
+        result = {}
+        for osm_id in osm_ids:
+            way = self.getWay(osm_id)
+            if way is not None:
+                result[osm_id] = way
+        return result
+
+    def getRelation(self, osm_id):
+        return self.relations.get(osm_id)
+
+    def getRelations(self, osm_ids):
+        result = {}
+        for osm_id in osm_ids:
+            relation = self.getRelation(osm_id)
+            if relation is not None:
+                result[osm_id] = relation
+        return result
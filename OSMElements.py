@@ -0,0 +1,117 @@
+#
+#  osm2spatialite
+#  Copyright (C) 2011 Daniel Sabo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# The OSM element types emitted by the parsers and accepted by the
+# datastores, filters and writers. They use __slots__ so an element is a
+# single small object instead of a dict.
+
+import array
+
+# The array typecode of 64 bit ids. Python 2 on Windows has no 64 bit
+# integer arrays, it's None there and ids are kept in plain lists of ints.
+ID_TYPECODE = 'l' if array.array('l').itemsize == 8 else None
+
+def idArray(ids=()):
+    """Return a new array of 64 bit ids, or a list where there are no 64 bit
+    integer arrays (see ID_TYPECODE)"""
+    if ID_TYPECODE is None:
+        return list(ids)
+    return array.array(ID_TYPECODE, ids)
+
+def refArray(refs=()):
+    """Return refs as an array of 64 bit node ids (see idArray)"""
+    if ID_TYPECODE is None:
+        if type(refs) is list:
+            return refs
+    elif isinstance(refs, array.array) and refs.typecode == ID_TYPECODE:
+        return refs
+    return idArray(refs)
+
+class Node(object):
+    """id: The node id
+    point: (lon, lat)
+    tags: A dict of tags
+    version: The object version, -1 if unknown"""
+    __slots__ = ("id", "point", "tags", "version")
+
+    def __init__(self, id, point, tags, version=-1):
+        self.id = id
+        self.point = point
+        self.tags = tags
+        self.version = version
+
+    def __reduce__(self):
+        return (Node, (self.id, self.point, self.tags, self.version))
+
+    def __repr__(self):
+        return "Node(%r, %r, %r, %r)" % (self.id, self.point, self.tags, self.version)
+
+class Way(object):
+    """id: The way id
+    nodes: The node refs, a sequence of 64 bit ids (see refArray)
+    tags: A dict of tags
+    version: The object version, -1 if unknown"""
+    __slots__ = ("id", "nodes", "tags", "version")
+
+    def __init__(self, id, nodes, tags, version=-1):
+        self.id = id
+        self.nodes = nodes
+        self.tags = tags
+        self.version = version
+
+    def __reduce__(self):
+        return (Way, (self.id, self.nodes, self.tags, self.version))
+
+    def __repr__(self):
+        return "Way(%r, %r, %r, %r)" % (self.id, list(self.nodes), self.tags, self.version)
+
+class Member(object):
+    """type: "node", "way" or "relation"
+    ref: The id of the member
+    role: The role string, e.g. "outer" """
+    __slots__ = ("type", "ref", "role")
+
+    def __init__(self, type, ref, role):
+        self.type = type
+        self.ref = ref
+        self.role = role
+
+    def __reduce__(self):
+        return (Member, (self.type, self.ref, self.role))
+
+    def __repr__(self):
+        return "Member(%r, %r, %r)" % (self.type, self.ref, self.role)
+
+class Relation(object):
+    """id: The relation id
+    members: A list of Members
+    tags: A dict of tags
+    version: The object version, -1 if unknown"""
+    __slots__ = ("id", "members", "tags", "version")
+
+    def __init__(self, id, members, tags, version=-1):
+        self.id = id
+        self.members = members
+        self.tags = tags
+        self.version = version
+
+    def __reduce__(self):
+        return (Relation, (self.id, self.members, self.tags, self.version))
+
+    def __repr__(self):
+        return "Relation(%r, %r, %r, %r)" % (self.id, self.members, self.tags, self.version)
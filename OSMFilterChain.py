@@ -0,0 +1,87 @@
+#
+#  osm2spatialite
+#  Copyright (C) 2011 Daniel Sabo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+
+ELEMENT_TYPES = ("node", "way", "relation")
+
+class FilterChain():
+    """The endElementFilters of a parser, resolved once per element type.
+
+    A filter is an object with a testElement(type, object) method that
+    returns the (possibly changed) object. Filters may also have:
+    - elementTypes: The element types they want to see, they are not
+      called for any other type. Without it they see every type.
+    - testElements(type, objects): Filter a whole list of objects of one
+      type at once, returns the list of results.
+    """
+    def __init__(self, filters, timing=False):
+        """timing: Keep the time spent in each filter, see getTimings"""
+        self.filters = list(filters)
+        self.timing = timing
+        self.times = [0.0] * len(self.filters)
+
+        # element type -> [(filter index, testElement, testElements or None), ...]
+        self.chains = {}
+        for elementType in ELEMENT_TYPES:
+            chain = []
+            for i,endFilter in enumerate(self.filters):
+                wanted = getattr(endFilter, "elementTypes", None)
+                if wanted is None or elementType in wanted:
+                    chain.append((i, endFilter.testElement, getattr(endFilter, "testElements", None)))
+            self.chains[elementType] = chain
+
+    def wants(self, elementType):
+        """Whether any filter looks at elementType"""
+        return bool(self.chains.get(elementType))
+
+    def apply(self, elementType, object):
+        """Run one object through the filters for its type"""
+        chain = self.chains.get(elementType)
+        if not chain:
+            return object
+        if self.timing:
+            for i,testElement,testElements in chain:
+                start = time.time()
+                object = testElement(elementType, object)
+                self.times[i] += time.time() - start
+        else:
+            for i,testElement,testElements in chain:
+                object = testElement(elementType, object)
+        return object
+
+    def applyBatch(self, elementType, objects):
+        """Run a list of objects of one type through the filters, each filter
+        sees the whole list before the next one runs. Returns the new list."""
+        chain = self.chains.get(elementType)
+        if not chain:
+            return objects
+        for i,testElement,testElements in chain:
+            if self.timing:
+                start = time.time()
+            if testElements is not None:
+                objects = testElements(elementType, objects)
+            else:
+                objects = [testElement(elementType, object) for object in objects]
+            if self.timing:
+                self.times[i] += time.time() - start
+        return objects
+
+    def getTimings(self):
+        """Return [(filter, seconds), ...] if timing is on"""
+        return zip(self.filters, self.times)
@@ -0,0 +1,100 @@
+#
+#  osm2spatialite
+#  Copyright (C) 2011 Daniel Sabo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Each chunk covers 2**CHUNK_SHIFT consecutive ids
+CHUNK_SHIFT = 16
+CHUNK_MASK  = (1 << CHUNK_SHIFT) - 1
+CHUNK_BYTES = (1 << CHUNK_SHIFT) // 8
+
+# Below this many ids the NumPy call overhead isn't worth it
+NUMPY_MIN_IDS = 64
+
+class IdBitSet():
+    """A set of OSM ids stored as one bit per id. The bits are kept in
+    bytearray chunks of 2**CHUNK_SHIFT ids (8KB) that are only allocated
+    for id ranges that are actually used, so a planet's worth of node
+    ids takes at most a few hundred MB."""
+    def __init__(self):
+        self.chunks = {}
+        self.count = 0
+
+    def _chunk(self, chunkNo):
+        try:
+            return self.chunks[chunkNo]
+        except KeyError:
+            chunk = self.chunks[chunkNo] = bytearray(CHUNK_BYTES)
+            return chunk
+
+    def add(self, osm_id):
+        chunk = self._chunk(osm_id >> CHUNK_SHIFT)
+        bit = osm_id & CHUNK_MASK
+        mask = 1 << (bit & 7)
+        if not chunk[bit >> 3] & mask:
+            chunk[bit >> 3] |= mask
+            self.count += 1
+
+    def addMany(self, osm_ids):
+        if numpy is None or len(osm_ids) < NUMPY_MIN_IDS:
+            for osm_id in osm_ids:
+                self.add(osm_id)
+            return
+
+        ids = numpy.asarray(osm_ids, numpy.int64)
+        chunkNos = ids >> CHUNK_SHIFT
+        for chunkNo in numpy.unique(chunkNos).tolist():
+            view = numpy.frombuffer(self._chunk(chunkNo), numpy.uint8)
+            bits = numpy.unique(ids[chunkNos == chunkNo] & CHUNK_MASK)
+            self.count += len(bits) - int(((view[bits >> 3] >> (bits & 7)) & 1).sum())
+            numpy.bitwise_or.at(view, bits >> 3, numpy.left_shift(1, bits & 7).astype(numpy.uint8))
+
+    def __contains__(self, osm_id):
+        chunk = self.chunks.get(osm_id >> CHUNK_SHIFT)
+        if chunk is None:
+            return False
+        bit = osm_id & CHUNK_MASK
+        return bool(chunk[bit >> 3] & (1 << (bit & 7)))
+
+    def containsMany(self, osm_ids):
+        """Return a list (or with NumPy, a bool array) telling which of osm_ids are in the set"""
+        if numpy is None or len(osm_ids) < NUMPY_MIN_IDS:
+            return [osm_id in self for osm_id in osm_ids]
+
+        ids = numpy.asarray(osm_ids, numpy.int64)
+        chunkNos = ids >> CHUNK_SHIFT
+        result = numpy.zeros(len(ids), numpy.bool_)
+        for chunkNo in numpy.unique(chunkNos).tolist():
+            chunk = self.chunks.get(chunkNo)
+            if chunk is None:
+                continue
+            view = numpy.frombuffer(chunk, numpy.uint8)
+            selected = chunkNos == chunkNo
+            bits = ids[selected] & CHUNK_MASK
+            result[selected] = (view[bits >> 3] >> (bits & 7)) & 1
+        return result
+
+    def __len__(self):
+        return self.count
+
+    def memoryUsage(self):
+        """The number of bytes used by the bits"""
+        return len(self.chunks) * CHUNK_BYTES
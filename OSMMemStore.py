@@ -16,6 +16,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from OSMElements import Node
+from OSMTagPool import EMPTY_TAGS
+
 class OSMMemStore():
     def __init__(self):
         self.ways  = {}
@@ -38,13 +41,19 @@ class OSMMemStore():
     
     # "Add" functions
     def addNode(self, object):            
-        self.nodes[object["id"]] = object
+        self.nodes[object.id] = object
+    
+    def addNodeBlock(self, ids, lons, lats, tags):
+        """Add a block of nodes given as columns, tags maps positions in
+        the block to the tags of tagged nodes"""
+        for i in xrange(len(ids)):
+            self.addNode(Node(int(ids[i]), (float(lons[i]), float(lats[i])), tags.get(i, EMPTY_TAGS)))
     
     def addWay(self, object):
-        self.ways[object["id"]] = object
+        self.ways[object.id] = object
     
     def addRelation(self, object):
-        self.relations[object["id"]] = object
+        self.relations[object.id] = object
 
     # "Delete" functions                
     def delWays(self, osm_ids):
@@ -73,10 +82,15 @@ class OSMMemStore():
         return len(self.relations)
                    
    # "Get" functions 
+    # getNode/getWay/getRelation return None for a missing id. The batch
+    # versions (getNodes/getWays/getRelations) return a dict of id -> object
+    # that leaves missing ids out, every datastore follows this.
     def _getSet(self, osm_ids, func):
         result = {}
         for osm_id in osm_ids:
-            result[osm_id] = func(id)
+            value = func(osm_id)
+            if value is not None:
+                result[osm_id] = value
         return result
     
     def getNode(self, osm_id):
@@ -87,6 +101,18 @@ class OSMMemStore():
     
     def getNodes(self, osm_ids):
         return self._getSet(osm_ids, self.getNode)
+    
+    def getNodePoints(self, osm_ids):
+        """Return the point of each of osm_ids, None for missing nodes"""
+        nodes = self.nodes
+        points = []
+        for osm_id in osm_ids:
+            node = nodes.get(osm_id)
+            if node is not None:
+                points.append(node.point)
+            else:
+                points.append(None)
+        return points
         
     def getWay(self, osm_id):
         try:
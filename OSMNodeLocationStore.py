@@ -0,0 +1,335 @@
+#
+#  osm2spatialite
+#  Copyright (C) 2011 Daniel Sabo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import mmap
+import struct
+import array
+import bisect
+
+from OSMElements import Node, ID_TYPECODE, idArray
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Coordinates are stored as fixed point integers of this many units per degree
+FIXED_SCALE = 10000000
+# Stored values are biased so that 0 (e.g. a hole in a sparse file) means "no node"
+FIXED_BIAS = 2 ** 31
+
+def toFixed(value):
+    return int(round(value * FIXED_SCALE))
+
+def fromFixed(value):
+    return value / float(FIXED_SCALE)
+
+def idsToNumpy(ids):
+    """Return an idArray as an int64 NumPy array, without a copy if possible"""
+    if ID_TYPECODE is None:
+        return numpy.array(ids, numpy.int64)
+    return numpy.frombuffer(ids, numpy.int64)
+
+def idsFromNumpy(ids):
+    """Return an int64 NumPy array as an idArray"""
+    if ID_TYPECODE is None:
+        return ids.tolist()
+    return array.array(ID_TYPECODE, ids.tostring())
+
+class FlatNodeLocations():
+    """Node coordinates in a memory mapped file indexed directly by node id,
+    8 bytes per id (like osm2pgsql's flat nodes). The file is sparse so ids
+    that are never used take no disk space."""
+
+    RECORD = struct.Struct("<II")
+
+    def __init__(self, filename):
+        """filename: The file to create, it must not exist yet because it's
+        deleted again by close()"""
+        self.filename = filename
+        self.count = 0
+
+        self.file = os.fdopen(os.open(filename, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0644), "w+b")
+        self.capacity = 0
+        self.map = None
+        self.view = None
+        self._grow(1024 * 1024)
+
+    def _grow(self, capacity):
+        """Make room for ids below capacity"""
+        self.view = None
+        if self.map is not None:
+            self.map.close()
+        self.file.truncate(capacity * self.RECORD.size)
+        self.capacity = capacity
+        self.map = mmap.mmap(self.file.fileno(), capacity * self.RECORD.size)
+        if numpy is not None:
+            self.view = numpy.frombuffer(self.map, numpy.uint32).reshape(capacity, 2)
+
+    def _reserve(self, minId, maxId):
+        if minId < 0:
+            raise ValueError("Negative node ids can't be stored in a flat node file")
+        if maxId >= self.capacity:
+            capacity = self.capacity
+            while capacity <= maxId:
+                capacity *= 2
+            self._grow(capacity)
+
+    def set(self, osm_id, lon, lat):
+        self._reserve(osm_id, osm_id)
+        self.RECORD.pack_into(self.map, osm_id * self.RECORD.size, toFixed(lon) + FIXED_BIAS, toFixed(lat) + FIXED_BIAS)
+        self.count += 1
+
+    def setBlock(self, ids, lons, lats):
+        if not len(ids):
+            return
+        if self.view is not None:
+            ids = numpy.asarray(ids, numpy.int64)
+            self._reserve(int(ids.min()), int(ids.max()))
+            self.view[ids, 0] = numpy.rint(numpy.asarray(lons) * FIXED_SCALE).astype(numpy.int64) + FIXED_BIAS
+            self.view[ids, 1] = numpy.rint(numpy.asarray(lats) * FIXED_SCALE).astype(numpy.int64) + FIXED_BIAS
+            self.count += len(ids)
+        else:
+            for i in xrange(len(ids)):
+                self.set(ids[i], lons[i], lats[i])
+
+    def get(self, osm_id):
+        if osm_id < 0 or osm_id >= self.capacity:
+            return None
+        lon,lat = self.RECORD.unpack_from(self.map, osm_id * self.RECORD.size)
+        if lon == 0:
+            return None
+        return [fromFixed(lon - FIXED_BIAS), fromFixed(lat - FIXED_BIAS)]
+
+    def getMany(self, osm_ids):
+        """Look up a list of ids at once, returns a list of [lon, lat] with None for missing nodes"""
+        if self.view is None or not len(osm_ids):
+            return [self.get(osm_id) for osm_id in osm_ids]
+
+        ids = numpy.asarray(osm_ids, numpy.int64)
+        inside = (ids >= 0) & (ids < self.capacity)
+        values = numpy.zeros((len(ids), 2), numpy.uint32)
+        values[inside] = self.view[ids[inside]]
+        missing = (values[:,0] == 0).tolist()
+        points = ((values.astype(numpy.int64) - FIXED_BIAS) / float(FIXED_SCALE)).tolist()
+        for i in xrange(len(points)):
+            if missing[i]:
+                points[i] = None
+        return points
+
+    def __len__(self):
+        return self.count
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        """Unmap and delete the file"""
+        self.view = None
+        self.map.close()
+        self.file.close()
+        os.unlink(self.filename)
+
+class SortedNodeLocations():
+    """Node coordinates in parallel in-memory arrays of ids and fixed point
+    coordinates (16 bytes per node), looked up by binary search. The arrays
+    are sorted once, on the first lookup after nodes were added out of order."""
+    def __init__(self):
+        self.ids  = idArray()
+        self.lons = array.array('i')
+        self.lats = array.array('i')
+        self.lastId = None
+        self.isSorted = True
+        self.needsFinish = False
+
+    def set(self, osm_id, lon, lat):
+        if self.lastId is not None and osm_id < self.lastId:
+            self.isSorted = False
+        self.lastId = osm_id
+        self.ids.append(osm_id)
+        self.lons.append(toFixed(lon))
+        self.lats.append(toFixed(lat))
+        self.needsFinish = True
+
+    def setBlock(self, ids, lons, lats):
+        if not len(ids):
+            return
+        if numpy is not None:
+            ids = numpy.asarray(ids, numpy.int64)
+            if (self.lastId is not None and ids[0] < self.lastId) or (numpy.diff(ids) < 0).any():
+                self.isSorted = False
+            self.lastId = int(ids[-1])
+            self.ids.extend(ids.tolist())
+            self.lons.fromstring(numpy.rint(numpy.asarray(lons) * FIXED_SCALE).astype(numpy.int32).tostring())
+            self.lats.fromstring(numpy.rint(numpy.asarray(lats) * FIXED_SCALE).astype(numpy.int32).tostring())
+            self.needsFinish = True
+        else:
+            for i in xrange(len(ids)):
+                self.set(ids[i], lons[i], lats[i])
+
+    def finish(self):
+        """Sort the arrays if nodes arrived out of order, this is done
+        automatically before lookups"""
+        self.needsFinish = False
+        if self.isSorted:
+            return
+        if numpy is not None:
+            ids = idsToNumpy(self.ids)
+            order = numpy.argsort(ids, kind="mergesort")
+            self.ids  = idsFromNumpy(ids[order])
+            self.lons = array.array('i', numpy.frombuffer(self.lons, numpy.int32)[order].tostring())
+            self.lats = array.array('i', numpy.frombuffer(self.lats, numpy.int32)[order].tostring())
+        else:
+            order = sorted(xrange(len(self.ids)), key=self.ids.__getitem__)
+            self.ids  = idArray([self.ids[i] for i in order])
+            self.lons = array.array('i', [self.lons[i] for i in order])
+            self.lats = array.array('i', [self.lats[i] for i in order])
+        self.isSorted = True
+
+    def get(self, osm_id):
+        if self.needsFinish:
+            self.finish()
+        i = bisect.bisect_left(self.ids, osm_id)
+        if i == len(self.ids) or self.ids[i] != osm_id:
+            return None
+        return [fromFixed(self.lons[i]), fromFixed(self.lats[i])]
+
+    def getMany(self, osm_ids):
+        """Look up a list of ids at once, returns a list of [lon, lat] with None for missing nodes"""
+        # NumPy's call overhead only pays off for longer ways, and the ids
+        # have to be in an array it can use without copying
+        if numpy is None or ID_TYPECODE is None or len(osm_ids) < 32 or not len(self.ids):
+            return [self.get(osm_id) for osm_id in osm_ids]
+        if self.needsFinish:
+            self.finish()
+
+        ids = idsToNumpy(self.ids)
+        query = numpy.asarray(osm_ids, ids.dtype)
+        found = numpy.searchsorted(ids, query)
+        found[found == len(ids)] = 0
+        missing = (ids[found] != query).tolist()
+        points = numpy.empty((len(query), 2))
+        points[:,0] = numpy.frombuffer(self.lons, numpy.int32)[found]
+        points[:,1] = numpy.frombuffer(self.lats, numpy.int32)[found]
+        points = (points / float(FIXED_SCALE)).tolist()
+        for i in xrange(len(points)):
+            if missing[i]:
+                points[i] = None
+        return points
+
+    def __len__(self):
+        return len(self.ids)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.ids  = idArray()
+        self.lons = array.array('i')
+        self.lats = array.array('i')
+
+class OSMNodeLocationStore():
+    """A datastore that keeps the coordinates of every node in a location
+    index (FlatNodeLocations or SortedNodeLocations) and passes everything else on to another
+    datastore. Only tagged nodes are stored as objects."""
+    def __init__(self, datastore, locations):
+        self.datastore = datastore
+        self.locations = locations
+
+    def commit(self):
+        self.datastore.commit()
+        self.locations.flush()
+
+    def cleanup(self):
+        self.datastore.cleanup()
+        self.locations.close()
+
+    # "Add" functions
+    def addNode(self, object):
+        lon,lat = object.point
+        self.locations.set(object.id, lon, lat)
+        if object.tags:
+            self.datastore.addNode(object)
+
+    def addNodeBlock(self, ids, lons, lats, tags):
+        self.locations.setBlock(ids, lons, lats)
+        for i,nodeTags in tags.iteritems():
+            if nodeTags:
+                self.datastore.addNode(Node(int(ids[i]), (float(lons[i]), float(lats[i])), nodeTags))
+
+    def addWay(self, object):
+        self.datastore.addWay(object)
+
+    def addRelation(self, object):
+        self.datastore.addRelation(object)
+
+    # "Delete" functions
+    def delWays(self, osm_ids):
+        self.datastore.delWays(osm_ids)
+
+    # "Iteration" functions, only tagged nodes are kept as objects
+    def getNodesIter(self):
+        return self.datastore.getNodesIter()
+
+    def getWaysIter(self):
+        return self.datastore.getWaysIter()
+
+    def getRelationsIter(self):
+        return self.datastore.getRelationsIter()
+
+    # Count data length
+    def getNumNodes(self):
+        return len(self.locations)
+    def getNumWays(self):
+        return self.datastore.getNumWays()
+    def getNumRelations(self):
+        return self.datastore.getNumRelations()
+
+    # "Get" functions
+    def getNode(self, osm_id):
+        node = self.datastore.getNode(osm_id)
+        if node is None:
+            point = self.locations.get(osm_id)
+            if point is not None:
+                node = Node(osm_id, tuple(point), {})
+        return node
+
+    def getNodes(self, osm_ids):
+        result = {}
+        for osm_id in osm_ids:
+            node = self.getNode(osm_id)
+            if node is not None:
+                result[osm_id] = node
+        return result
+
+    def getNodePoints(self, osm_ids):
+        """Return the [lon, lat] of each of osm_ids, None for missing nodes"""
+        return self.locations.getMany(osm_ids)
+
+    def getWay(self, osm_id):
+        return self.datastore.getWay(osm_id)
+
+    def getWays(self, osm_ids):
+        return self.datastore.getWays(osm_ids)
+
+    def getRelation(self, osm_id):
+        return self.datastore.getRelation(osm_id)
+
+    def getRelations(self, osm_ids):
+        return self.datastore.getRelations(osm_ids)
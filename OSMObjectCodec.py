@@ -0,0 +1,214 @@
+#
+#  osm2spatialite
+#  Copyright (C) 2011 Daniel Genrich
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import struct
+from OSMElements import Node, Way, Relation, Member, idArray
+
+# Coordinates are stored as fixed point integers of this many units per degree
+FIXED_SCALE = 10000000
+
+MEMBER_TYPES = ["node", "way", "relation"]
+MEMBER_CODES = {"node":0, "way":1, "relation":2}
+
+# version, lon and lat of a node
+NODE_HEADER = struct.Struct("<iii")
+
+def writeVarint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def writeSigned(out, value):
+    """Write a zigzag encoded varint, so small negative numbers stay small"""
+    if value >= 0:
+        writeVarint(out, value << 1)
+    else:
+        writeVarint(out, ((-value) << 1) - 1)
+
+def readVarint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return (result, pos)
+        shift += 7
+
+def readSigned(data, pos):
+    value,pos = readVarint(data, pos)
+    if value & 1:
+        return (-((value + 1) >> 1), pos)
+    return (value >> 1, pos)
+
+class OSMObjectCodec():
+    """A compact binary encoding for cached nodes, ways and relations.
+
+    Ids are not encoded (they are the key the object is stored under),
+    coordinates are fixed point, way and member refs are delta and varint
+    encoded and tag keys and values are indices into a string table that
+    is kept in memory for the lifetime of the codec."""
+
+    def __init__(self, maxStrings=1000000, maxStringLength=32):
+        """Strings longer than maxStringLength (e.g. most names) and any new
+        strings once the table holds maxStrings entries are stored inline"""
+        self.strings = []
+        self.stringIndex = {}
+        self.maxStrings = maxStrings
+        self.maxStringLength = maxStringLength
+
+    def writeString(self, out, s):
+        try:
+            writeVarint(out, self.stringIndex[s] + 1)
+            return
+        except KeyError:
+            pass
+
+        if len(s) <= self.maxStringLength and len(self.strings) < self.maxStrings:
+            self.stringIndex[s] = len(self.strings)
+            self.strings.append(s)
+            writeVarint(out, len(self.strings))
+            return
+
+        if isinstance(s, unicode):
+            s = s.encode("utf-8")
+        out.append(0)
+        writeVarint(out, len(s))
+        out += s
+
+    def decodeString(self, s):
+        """Turn stored UTF-8 into an interned str if it's ASCII, unicode otherwise"""
+        s = s.decode("utf-8")
+        try:
+            return intern(str(s))
+        except UnicodeEncodeError:
+            return s
+
+    def readString(self, data, pos):
+        index,pos = readVarint(data, pos)
+        if index:
+            return (self.strings[index - 1], pos)
+        length,pos = readVarint(data, pos)
+        return (self.decodeString(str(data[pos:pos + length])), pos + length)
+
+    def writeTags(self, out, tags):
+        writeVarint(out, len(tags))
+        for key,value in tags.iteritems():
+            self.writeString(out, key)
+            self.writeString(out, value)
+
+    def readTags(self, data, pos):
+        count,pos = readVarint(data, pos)
+        tags = {}
+        for i in xrange(count):
+            key,pos = self.readString(data, pos)
+            tags[key],pos = self.readString(data, pos)
+        return (tags, pos)
+
+    # Nodes, the fixed size header is followed by the tags (if any)
+    def encodeNode(self, object):
+        point = object.point
+        data = NODE_HEADER.pack(object.version, int(round(point[0] * FIXED_SCALE)), int(round(point[1] * FIXED_SCALE)))
+        if not object.tags:
+            return data
+        out = bytearray(data)
+        self.writeTags(out, object.tags)
+        return str(out)
+
+    def decodeNodePoint(self, data):
+        """Decode only the [lon, lat] of an encoded node"""
+        version,lon,lat = NODE_HEADER.unpack_from(data)
+        return [lon / float(FIXED_SCALE), lat / float(FIXED_SCALE)]
+
+    def decodeNode(self, osm_id, data):
+        version,lon,lat = NODE_HEADER.unpack_from(data)
+        if len(data) > NODE_HEADER.size:
+            tags = self.readTags(bytearray(data), NODE_HEADER.size)[0]
+        else:
+            tags = {}
+        return Node(osm_id, (lon / float(FIXED_SCALE), lat / float(FIXED_SCALE)), tags, version)
+
+    # Ways
+    def encodeWay(self, object):
+        out = bytearray()
+        writeSigned(out, object.version)
+        refs = object.nodes
+        writeVarint(out, len(refs))
+        last = 0
+        append = out.append
+        for ref in refs:
+            delta = ref - last
+            last = ref
+            # Most deltas fit in one byte, so handle that inline
+            if -64 <= delta < 64:
+                append(delta << 1 if delta >= 0 else ((-delta) << 1) - 1)
+            else:
+                writeSigned(out, delta)
+        self.writeTags(out, object.tags)
+        return str(out)
+
+    def decodeWay(self, osm_id, data):
+        data = bytearray(data)
+        version,pos = readSigned(data, 0)
+        count,pos = readVarint(data, pos)
+        refs = idArray()
+        append = refs.append
+        last = 0
+        for i in xrange(count):
+            b = data[pos]
+            if b & 0x80:
+                delta,pos = readSigned(data, pos)
+            else:
+                pos += 1
+                delta = -((b + 1) >> 1) if b & 1 else b >> 1
+            last += delta
+            append(last)
+        tags,pos = self.readTags(data, pos)
+        return Way(osm_id, refs, tags, version)
+
+    # Relations
+    def encodeRelation(self, object):
+        out = bytearray()
+        writeSigned(out, object.version)
+        members = object.members
+        writeVarint(out, len(members))
+        last = 0
+        for member in members:
+            out.append(MEMBER_CODES[member.type])
+            writeSigned(out, member.ref - last)
+            last = member.ref
+            self.writeString(out, member.role)
+        self.writeTags(out, object.tags)
+        return str(out)
+
+    def decodeRelation(self, osm_id, data):
+        data = bytearray(data)
+        version,pos = readSigned(data, 0)
+        count,pos = readVarint(data, pos)
+        members = []
+        last = 0
+        for i in xrange(count):
+            memberType = MEMBER_TYPES[data[pos]]
+            delta,pos = readSigned(data, pos + 1)
+            last += delta
+            role,pos = self.readString(data, pos)
+            members.append(Member(memberType, last, role))
+        tags,pos = self.readTags(data, pos)
+        return Relation(osm_id, members, tags, version)
@@ -20,209 +20,689 @@ import fileformat_pb2,osmformat_pb2
 import struct
 import zlib
 import os.path
-#import time
+import mmap
+import collections
+import multiprocessing
+import threading
+import Queue
+import sys
+import cPickle
+import array
+from OSMElements import Node, Way, Relation, Member, idArray
+from OSMFilterChain import FilterChain
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 NANODEG = .000000001
 
+# Relation member types by their Relation.MemberType value
+MEMBER_TYPES = ("node", "way", "relation")
+
+# Non-ASCII strings shared between blocks, ASCII strings use intern() instead
+internedStrings = {}
+MAX_INTERNED_STRINGS = 100000
+
+def internString(s):
+    """Decode a string table entry into a shared object, ASCII strings are
+    interned like in OSMXMLParser"""
+    s = s.decode("utf-8")
+    try:
+        return intern(str(s))
+    except UnicodeEncodeError:
+        try:
+            return internedStrings[s]
+        except KeyError:
+            if len(internedStrings) < MAX_INTERNED_STRINGS:
+                internedStrings[s] = s
+            return s
+
+def decodeStringTable(stringtable):
+    """Decode every string of a block's StringTable once"""
+    return [internString(s) for s in stringtable.s]
+
+class LazyStringTable():
+    """A block's StringTable that decodes each entry the first time it's
+    used, so the keys and values of skipped tags are never decoded"""
+    def __init__(self, stringtable):
+        self.raw = stringtable.s
+        self.strings = [None] * len(self.raw)
+
+    def __getitem__(self, i):
+        s = self.strings[i]
+        if s is None:
+            s = self.strings[i] = internString(self.raw[i])
+        return s
+
+def keptStrings(stringtable, keepTags):
+    """Return a list of flags telling which entries of a StringTable are keys
+    in keepTags, or None if every tag is kept"""
+    if keepTags is None:
+        return None
+    return [s in keepTags for s in stringtable.s]
+
+def inflateBlob(data):
+    """Unpack a serialized Blob message and return the raw block it contains.
+    The Blob is read straight from the wire format, so data can be a buffer
+    into the mapped file and its payload reaches zlib without being copied."""
+    payloads = {}
+    raw_size = 0
+    pos = 0
+    end = len(data)
+    while pos < end:
+        key,pos = readVarint(data, pos)
+        if key & 7 == 2:
+            length,pos = readVarint(data, pos)
+            payloads[key >> 3] = buffer(data, pos, length)
+            pos += length
+        elif key >> 3 == 2:
+            raw_size,pos = readVarint(data, pos)
+        else:
+            pos = skipField(data, pos, key & 7)
+    
+    # Blob fields: raw = 1, raw_size = 2, zlib_data = 3, lzma_data = 4, bzip2_data = 5
+    if 1 in payloads:
+        return str(payloads[1])
+    elif 3 in payloads:
+        return zlib.decompress(payloads[3],15,raw_size)
+    elif 4 in payloads:
+        raise Exception("Unsupported compression: lzma")
+    elif 5 in payloads:
+        raise Exception("Unsupported compression: bzip2")
+    return ""
+
+def decodeDenseNodes(dense, strings, granularity, lat_offset, lon_offset, keep=None):
+    """Delta decode a whole DenseNodes group at once.
+    Returns (ids, lons, lats, tags), tags maps the position of each tagged node
+    in the group to its tags. With NumPy the columns are arrays, otherwise an
+    id list and array('d') coordinates. If keep is given (see keptStrings) only
+    tags with those keys are decoded."""
+    count = len(dense.id)
+    kv = dense.keys_vals
+    
+    if numpy is not None:
+        ids  = numpy.cumsum(numpy.fromiter(dense.id, numpy.int64, count))
+        lats = NANODEG * (lat_offset + granularity * numpy.cumsum(numpy.fromiter(dense.lat, numpy.int64, count)))
+        lons = NANODEG * (lon_offset + granularity * numpy.cumsum(numpy.fromiter(dense.lon, numpy.int64, count)))
+        
+        tagRanges = []
+        if kv:
+            kv = numpy.fromiter(kv, numpy.int64, len(kv))
+            # Each node's keys and values are terminated by a 0
+            ends = numpy.flatnonzero(kv == 0)
+            starts = numpy.empty_like(ends)
+            starts[0] = 0
+            starts[1:] = ends[:-1] + 1
+            tagged = numpy.flatnonzero(ends != starts)
+            tagRanges = zip(tagged.tolist(), starts[tagged].tolist(), ends[tagged].tolist())
+            kv = kv.tolist()
+    else:
+        ids  = []
+        lats = array.array('d')
+        lons = array.array('d')
+        scale = NANODEG * granularity
+        last_id = last_lat = last_lon = 0
+        for osm_id,lat,lon in zip(dense.id, dense.lat, dense.lon):
+            last_id  += osm_id
+            last_lat += lat
+            last_lon += lon
+            ids.append(last_id)
+            lats.append(NANODEG * lat_offset + scale * last_lat)
+            lons.append(NANODEG * lon_offset + scale * last_lon)
+        
+        tagRanges = []
+        if kv:
+            kv = list(kv)
+            i = 0
+            pos = 0
+            start = 0
+            while pos < len(kv):
+                if kv[pos] == 0:
+                    if pos != start:
+                        tagRanges.append((i, start, pos))
+                    i += 1
+                    pos += 1
+                    start = pos
+                else:
+                    pos += 2
+    
+    tags = {}
+    for i,start,end in tagRanges:
+        nodeTags = {}
+        for pos in xrange(start, end, 2):
+            if keep is None or keep[kv[pos]]:
+                nodeTags[strings[kv[pos]]] = strings[kv[pos + 1]]
+        if nodeTags:
+            tags[i] = nodeTags
+    
+    return (ids, lons, lats, tags)
+
+def decodePrimitiveBlock(data, keepTags=None):
+    """Decode a raw PrimitiveBlock into a list of ("node"|"way"|"relation", objects)
+    batches, in the order they appear in the block. DenseNodes groups are
+    returned as ("nodeblock", (ids, lons, lats, tags)) batches.
+    keepTags: If given, a set of UTF-8 encoded keys, other tags are skipped"""
+    pb = osmformat_pb2.PrimitiveBlock()
+    pb.ParseFromString(data)
+    
+    keep = keptStrings(pb.stringtable, keepTags)
+    if keep is None:
+        strings = decodeStringTable(pb.stringtable)
+    else:
+        strings = LazyStringTable(pb.stringtable)
+    
+    granularity = pb.granularity or 100
+    lat_offset  = pb.lat_offset or 0
+    lon_offset  = pb.lon_offset or 0
+    date_granularity = pb.date_granularity or 1000
+    
+    batches = []
+    for group in pb.primitivegroup:
+        nodes = []
+        for node in group.nodes:
+            tags = {}
+            for k,v in zip(node.keys, node.vals):
+                if keep is None or keep[k]:
+                    tags[strings[k]] = strings[v]
+                
+            lat = .000000001 * (lat_offset + (granularity * node.lat))
+            lon = .000000001 * (lon_offset + (granularity * node.lon))
+            
+            nodes.append(Node(node.id, (lon, lat), tags))
+        if nodes:
+            batches.append(("node", nodes))
+        if group.dense.id:
+            batches.append(("nodeblock", decodeDenseNodes(group.dense, strings, granularity, lat_offset, lon_offset, keep)))
+        
+        ways = []
+        for way in group.ways:
+            tags = {}
+            for k,v in zip(way.keys, way.vals):
+                if keep is None or keep[k]:
+                    tags[strings[k]] = strings[v]
+            
+            refs = idArray()
+            append = refs.append
+            last_ref = 0
+            for ref in way.refs:
+                last_ref += ref
+                append(last_ref)
+            
+            ways.append(Way(way.id, refs, tags))
+        if ways:
+            batches.append(("way", ways))
+        
+        rels = []
+        for rel in group.relations:
+            tags = {}
+            for k,v in zip(rel.keys, rel.vals):
+                if keep is None or keep[k]:
+                    tags[strings[k]] = strings[v]
+            
+            members = []
+            last_ref = 0
+            for role,ref,ref_type in zip(rel.roles_sid, rel.memids, rel.types):
+                ref = ref + last_ref
+                #members.append([{0:"N", 1:"W", 2:"R"}[ref_type], ref, strings[role]])
+                members.append(Member(MEMBER_TYPES[ref_type], ref, strings[role]))
+                last_ref = ref
+                
+            rels.append(Relation(rel.id, members, tags))
+        if rels:
+            batches.append(("relation", rels))
+    
+    return batches
+
+def decodeBlob(data, keepTags=None):
+    """Inflate and decode a serialized Blob, this is what the worker processes run"""
+    return decodePrimitiveBlock(inflateBlob(data), keepTags)
+
+# The mapped input file and the keepTags of decoding worker processes, see openMappedFile
+mappedFile = None
+mappedKeepTags = None
+
+def openMappedFile(filename, keepTags=None):
+    """Map filename read only, this is the initializer of the worker processes"""
+    global mappedFile, mappedKeepTags
+    mappedFile = mapFile(filename)
+    mappedKeepTags = keepTags
+
+def decodeMappedBlob(location):
+    """Decode the blob at (offset, size) of the mapped file"""
+    offset,size = location
+    return decodeBlob(buffer(mappedFile, offset, size), mappedKeepTags)
+
+def mapFile(filename):
+    """Map filename read only, empty files (which can't be mapped) give an empty string"""
+    f = open(filename, "rb")
+    try:
+        if os.path.getsize(filename) == 0:
+            return ""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+def readVarint(data, pos):
+    """Read a protobuf varint from data at pos, returns (value, new pos)"""
+    result = 0
+    shift = 0
+    while True:
+        b = ord(data[pos])
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return (result, pos)
+        shift += 7
+
+def skipField(data, pos, wireType):
+    """Return the position after a field value of the given wire type"""
+    if wireType == 0:
+        return readVarint(data, pos)[1]
+    elif wireType == 1:
+        return pos + 8
+    elif wireType == 2:
+        length,pos = readVarint(data, pos)
+        return pos + length
+    elif wireType == 5:
+        return pos + 4
+    raise Exception("Unsupported wire type: %d" % wireType)
+
+# The kind of PrimitiveGroup each decoded batch type comes from
+BATCH_KINDS = {"node":"nodes", "nodeblock":"dense", "way":"ways", "relation":"relations"}
+
+# Which group kinds hold each element type
+ELEMENT_KINDS = {
+    "node":["nodes", "dense"],
+    "way":["ways"],
+    "relation":["relations"],
+    }
+
+def readIndexFile(indexfilename):
+    """Return the contents of a saved OSMPBFIndex, or None if indexfilename
+    is missing or isn't an index"""
+    try:
+        f = open(indexfilename, "rb")
+    except IOError:
+        return None
+    try:
+        try:
+            saved = cPickle.load(f)
+        except Exception:
+            return None
+    finally:
+        f.close()
+    if not isinstance(saved, dict) or set(saved) != set(["filesize", "mtime", "blobs"]):
+        return None
+    return saved
+
+def isIndexFile(indexfilename):
+    """Check if indexfilename is a saved OSMPBFIndex, which may be overwritten"""
+    return readIndexFile(indexfilename) is not None
+
+class OSMPBFIndex():
+    """The offset, size and content of every data blob in a PBF file, so passes
+    that only need some element types can seek straight to their blocks. It's
+    recorded while the whole file is parsed, see OSMPBFParser.parse."""
+    def __init__(self, filename=None):
+        self.filesize = None
+        self.mtime = None
+        # [(offset, size, kinds), ...] for each OSMData blob, in file order
+        self.blobs = []
+        if filename is not None:
+            self.filesize = os.path.getsize(filename)
+            self.mtime = os.path.getmtime(filename)
+    
+    def add(self, offset, size, batches):
+        """Record the next blob from the batches decoded from it"""
+        kinds = frozenset(BATCH_KINDS[elementType] for elementType,objects in batches)
+        self.blobs.append((offset, size, kinds))
+    
+    def load(self, filename, indexfilename):
+        """Load a sidecar index, returns False if it is missing or doesn't match filename"""
+        saved = readIndexFile(indexfilename)
+        if saved is None:
+            return False
+        
+        self.filesize = saved["filesize"]
+        self.mtime = saved["mtime"]
+        self.blobs = saved["blobs"]
+        return self.matches(filename)
+    
+    def matches(self, filename):
+        """Check the index was built from the current version of filename"""
+        return self.filesize == os.path.getsize(filename) and self.mtime == os.path.getmtime(filename)
+    
+    def save(self, indexfilename):
+        """Save the index, an existing indexfilename is only replaced if it is an index too"""
+        if os.path.exists(indexfilename) and not isIndexFile(indexfilename):
+            raise IOError("%s exists and isn't a PBF index, not overwriting it" % indexfilename)
+        
+        # Write a new file and move it into place, so a failed write doesn't
+        # leave a broken index behind
+        tempfilename = indexfilename + ".tmp"
+        f = open(tempfilename, "wb")
+        try:
+            cPickle.dump({
+                "filesize":self.filesize,
+                "mtime":self.mtime,
+                "blobs":self.blobs,
+                }, f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        try:
+            os.rename(tempfilename, indexfilename)
+        except OSError:
+            # Windows can't rename over an existing file
+            os.unlink(indexfilename)
+            os.rename(tempfilename, indexfilename)
+    
+    def find(self, elementTypes):
+        """Return (offset, size) of the blobs containing any of elementTypes
+        ("node", "way", "relation"), in file order"""
+        wanted = set()
+        for elementType in elementTypes:
+            wanted.update(ELEMENT_KINDS[elementType])
+        return [(offset, size) for offset,size,kinds in self.blobs if kinds & wanted]
+
 class OSMPBFParser():
-    def __init__(self):
+    def __init__(self, workers=1, readAhead=4, inflateThreads=1):
+        """workers: The number of processes used to decode blocks, with 1 everything
+        is done in the calling process
+        readAhead: How many blobs background threads may read and inflate ahead of
+        the block being decoded (single process only), 0 turns this off
+        inflateThreads: The number of background threads inflating blobs"""
         self.blob_header = fileformat_pb2.BlockHeader()
-        self.blob = fileformat_pb2.Blob()
         
-        self.pb = osmformat_pb2.PrimitiveBlock()
+        self.pbf_map = None
+        self.workers = workers
+        self.readAhead = readAhead
+        self.inflateThreads = inflateThreads
         
-        self.pbf_file = None
+        # If set the blob index is kept in this file between runs
+        self.indexFilename = None
+        self.index = None
+        # The index being recorded by the current pass, if any
+        self.newIndex = None
         
         self.endElementFilters = []
         
+        # If set, the tags of every object are replaced by the shared
+        # copy from this OSMTagPool.TagSetPool after the filters ran
+        self.tagPool = None
+        
+        # If set, only tags with these keys are decoded
+        self.keepTags = None
+        
+        # Keep the time spent in each endElementFilter, see OSMFilterChain
+        self.filterTiming = False
+        self.filterChain = None
+        
     def reportProgress(self, progress):
         pass
     
     def reportFinished(self):
         pass
     
-    def parse(self, filename, datastore):
-        self.pbf_file = open(filename, "r")
+    def parse(self, filename, datastore, elementTypes=None):
+        """elementTypes: If given only these element types ("node", "way", "relation")
+        are parsed, and only the blocks that contain them are read"""
+        if self.index is None or not self.index.matches(filename):
+            self.index = self.readIndex(filename)
+        # Without an index every block has to be read anyway, so record one
+        # on the way for later passes
+        self.newIndex = None
+        if self.index is None:
+            self.newIndex = OSMPBFIndex(filename)
+        
+        self.filename = filename
+        self.pbf_map = mapFile(filename)
+        self.offset = 0
         self.datastore = datastore
+        self.elementTypes = elementTypes
+        self.filterChain = FilterChain(self.endElementFilters, self.filterTiming)
         
         self.nodeCount = 0
         self.wayCount = 0
         self.relCount = 0
         
-        self.filesize = os.path.getsize(filename)
-        self.pstart = self.pbf_file.tell()
+        self.filesize = len(self.pbf_map)
+        keepTags = self.encodedKeepTags()
         
         try:
-            while self.readBlob():
-                pass
+            if self.workers > 1:
+                self.parseParallel()
+            elif self.readAhead > 0:
+                for block,offset,size in self.inflatedBlobs():
+                    self.parsedBlob(decodePrimitiveBlock(block, keepTags), offset, size)
+            else:
+                for offset,size in self.dataBlobs():
+                    self.parsedBlob(decodeBlob(buffer(self.pbf_map, offset, size), keepTags), offset, size)
         finally:
-            self.pbf_file.close()
-            self.pbf_file = None
+            if self.filesize:
+                self.pbf_map.close()
+            self.pbf_map = None
+        
+        if self.newIndex is not None:
+            self.index = self.newIndex
+            self.newIndex = None
+            if self.indexFilename:
+                self.index.save(self.indexFilename)
             
         self.reportFinished()
         
-    def readBlob(self):
-#        t0 = time.time()
-        data = self.pbf_file.read(4)
-        if not data:
-            return False
+    def encodedKeepTags(self):
+        """keepTags as UTF-8 strings, to match them against undecoded string tables"""
+        if self.keepTags is None:
+            return None
+        return frozenset(unicode(key).encode("utf-8") for key in self.keepTags)
+    
+    def readIndex(self, filename):
+        """Load the saved index of filename, None if there is no usable one"""
+        index = OSMPBFIndex()
+        if self.indexFilename and index.load(filename, self.indexFilename):
+            return index
+        return None
+    
+    def readBlobData(self):
+        """Read the next BlockHeader from the mapped file and skip over its Blob.
+        Returns a (type, offset, size) tuple for the Blob or None at the end of the file"""
+        if self.offset + 4 > self.filesize:
+            return None
 
-        size = struct.unpack("!I", data)[0]
-        
-        data = self.pbf_file.read(size)
-        self.blob_header.ParseFromString(data)
-        data = self.pbf_file.read(self.blob_header.datasize)
-        self.blob.ParseFromString(data)
-        
-        if self.blob.raw:
-            data = self.blob.raw
-        elif self.blob.zlib_data:
-            data = zlib.decompress(self.blob.zlib_data,15,self.blob.raw_size)
-        elif self.blob.lzma_data:
-            raise Exception("Unsupported compression: lzma")
-        elif self.blob.bzip2_data:
-            raise Exception("Unsupported compression: bzip2")
-        
-        self.pb = osmformat_pb2.PrimitiveBlock()
-        self.pb.ParseFromString(data)
-        
-        granularity = self.pb.granularity or 100
-        lat_offset  = self.pb.lat_offset or 0
-        lon_offset  = self.pb.lat_offset or 0
-        date_granularity = self.pb.date_granularity or 1000
-        
-        def denseTagYielder(dense, stringtable):
-            kv = dense.keys_vals
-            if not kv:
-                return
-            tags = {}
-            i = 0
-            while i < len(kv):
-                key = kv[i]
-                if 0 == key:
-                    yield tags
-                    tags = {}
-                else:
-                    i += 1
-                    tags[stringtable[key].decode("utf-8")] = stringtable[kv[i]].decode("utf-8")
-                i += 1
+        size = struct.unpack_from("!I", self.pbf_map, self.offset)[0]
+        self.offset += 4
         
-        def denseYielder(dense, stringtable):
-            last_id  = 0
-            last_lat = 0.0
-            last_lon = 0.0
-            
-            tagger = denseTagYielder(dense, stringtable)
-            for i,osm_id in enumerate(dense.id):
-                lat = .000000001 * (lat_offset + (granularity * dense.lat[i]))
-                lon = .000000001 * (lon_offset + (granularity * dense.lon[i]))
-                
-                if dense.keys_vals:
-                    tags = tagger.next()
-                else:
-                    tags = {}
-                osm_id = osm_id + last_id
-                lat = lat + last_lat
-                lon = lon + last_lon
-                yield {"id":osm_id, "point":[lon, lat], "tags":tags, "version":-1}
-                last_id  = osm_id
-                last_lat = lat
-                last_lon = lon
-        
-        for group in self.pb.primitivegroup:
-            for node in group.nodes:
-                tags = {}
-                for k,v in zip(node.keys, node.vals):
-                    tags[self.pb.stringtable.s[k].decode("utf-8")] = self.pb.stringtable.s[v].decode("utf-8")
-                    
-                lat = .000000001 * (lat_offset + (granularity * node.lat))
-                lon = .000000001 * (lon_offset + (granularity * node.lon))
-                
-                self.parsedNode({"id":node.id, "point":[lon, lat], "tags":tags, "version":-1})
-            if group.dense:
-                #print "Dense: Nodes:", len(group.dense.id)
-                for node in denseYielder(group.dense, self.pb.stringtable.s):
-                    self.parsedNode(node)
-            for way in group.ways:
-                tags = {}
-                for k,v in zip(way.keys, way.vals):
-                    tags[self.pb.stringtable.s[k].decode("utf-8")] = self.pb.stringtable.s[v].decode("utf-8")
-                
-                refs = []
-                last_ref = 0
-                for ref in way.refs:
-                    ref = ref + last_ref
-                    refs.append(ref)
-                    last_ref = ref
-                
-                self.parsedWay({"id":way.id, "nodes":refs, "tags":tags, "version":-1})
-            for rel in group.relations:
-                tags = {}
-                for k,v in zip(rel.keys, rel.vals):
-                    tags[self.pb.stringtable.s[k].decode("utf-8")] = self.pb.stringtable.s[v].decode("utf-8")
-                
-                members = []
-                last_ref = 0
-                for role,ref,ref_type in zip(rel.roles_sid, rel.memids, rel.types):
-                    ref = ref + last_ref
-                    #members.append([{0:"N", 1:"W", 2:"R"}[ref_type], ref, self.pb.stringtable.s[role]])
-                    members.append({
-                        "type":{0:"node", 1:"way", 2:"relation"}[ref_type],
-                        "ref":ref,
-                        "role":self.pb.stringtable.s[role]})
-                    last_ref = ref
-                    
-                self.parsedRelation({"id":rel.id, "members":members, "tags":tags, "version":-1})
-        
-        
-#        percent = self.pbf_file.tell() / float(self.filesize) * 100.0
-
-#        thispercent = ((self.pbf_file.tell() - self.pstart) / float(self.filesize - self.pstart)) * 100.0
-#        totalTime = time.time() - self.tstart
-#        remaining = totalTime / (thispercent / 100)
-#        remaining = "%d:%02d:%07.4f" % (
-#          int(remaining / 3600),
-#          int(remaining / 60) % 60,
-#          remaining % 60,
-#        )
-
-#        print "%.2f%% (%d nodes, %d ways, %d relations) (%.4fs) est %s\r" % \
-#          (percent,
-#          self.objectReadCount[0],
-#          self.objectReadCount[1],
-#          self.objectReadCount[2],
-#          time.time() - t0,
-#          remaining,)
-
-
+        self.blob_header.ParseFromString(self.pbf_map[self.offset:self.offset + size])
+        self.offset += size
+        
+        offset = self.offset
+        self.offset += self.blob_header.datasize
+        
+        return (self.blob_header.type, offset, self.blob_header.datasize)
+        
+    def dataBlobs(self):
+        """Yield (offset, size) for each OSMData blob that needs decoding"""
+        if self.elementTypes is None or self.index is None:
+            while True:
+                blob = self.readBlobData()
+                if blob is None:
+                    return
+                blobType,offset,size = blob
+                if blobType == "OSMData":
+                    yield (offset, size)
+        else:
+            for location in self.index.find(self.elementTypes):
+                yield location
+    
+    def inflatedBlobs(self):
+        """Yield (block, offset, size) for each OSMData blob, like dataBlobs but
+        with the blobs read and inflated by background threads. At most readAhead
+        blobs are kept waiting, which caps the memory used."""
+        # Results are queued in file order as one item queues, which the
+        # inflate threads fill in whatever order they finish
+        results = Queue.Queue(self.readAhead)
+        work = Queue.Queue()
+        stop = threading.Event()
+        
+        def put(queue, item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return
+                except Queue.Full:
+                    pass
+        
+        def reader():
+            try:
+                try:
+                    for offset,size in self.dataBlobs():
+                        slot = Queue.Queue(1)
+                        put(results, (slot, (offset, size)))
+                        if stop.is_set():
+                            break
+                        work.put((buffer(self.pbf_map, offset, size), slot))
+                except Exception:
+                    slot = Queue.Queue(1)
+                    slot.put((False, sys.exc_info()))
+                    put(results, (slot, None))
+            finally:
+                put(results, None)
+                for i in range(self.inflateThreads):
+                    work.put(None)
+        
+        def inflater():
+            while True:
+                item = work.get()
+                if item is None:
+                    return
+                data,slot = item
+                try:
+                    slot.put((True, inflateBlob(data)))
+                except Exception:
+                    slot.put((False, sys.exc_info()))
+        
+        threads = [threading.Thread(target=reader)]
+        threads.extend([threading.Thread(target=inflater) for i in range(self.inflateThreads)])
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        
+        try:
+            while True:
+                item = results.get()
+                if item is None:
+                    break
+                slot,location = item
+                ok,block = slot.get()
+                if not ok:
+                    raise block[0], block[1], block[2]
+                yield (block, location[0], location[1])
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+    
+    def parseParallel(self):
+        """Decode blocks in a pool of worker processes, the results are
+        handled here in file order"""
+        # Bound the number of blobs in flight, the pool would otherwise
+        # read the whole file into its task queue
+        inFlight = threading.Semaphore(self.workers * 2)
+        positions = collections.deque()
+        
+        def dataBlobs():
+            for offset,size in self.dataBlobs():
+                inFlight.acquire()
+                positions.append((offset, size))
+                yield (offset, size)
+        
+        # The workers map the file themselves, only blob locations are sent to them
+        pool = multiprocessing.Pool(self.workers, openMappedFile, (self.filename, self.encodedKeepTags()))
+        try:
+            for batches in pool.imap(decodeMappedBlob, dataBlobs()):
+                inFlight.release()
+                offset,size = positions.popleft()
+                self.parsedBlob(batches, offset, size)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    
+    def parsedBlob(self, batches, offset, size):
+        if self.newIndex is not None:
+            self.newIndex.add(offset, size, batches)
+        self.parsedBatches(batches)
+        self.reportBlockProgress(offset + size)
+    
+    def parsedBatches(self, batches):
+        for elementType,objects in batches:
+            if self.elementTypes is not None:
+                batchElement = "node" if elementType == "nodeblock" else elementType
+                if batchElement not in self.elementTypes:
+                    continue
+            if elementType == "node":
+                self.parsedNodes(objects)
+            elif elementType == "nodeblock":
+                self.parsedNodeBlock(*objects)
+            elif elementType == "way":
+                self.parsedWays(objects)
+            elif elementType == "relation":
+                self.parsedRelations(objects)
+    
+    def reportBlockProgress(self, filepos):
         self.reportProgress({
             "nodes":self.nodeCount,
             "ways":self.wayCount,
             "relations":self.relCount,
             "filesize":self.filesize,
-            "filepos":self.pbf_file.tell(),
+            "filepos":filepos,
             })
-        
-        return True
     
-    def parsedNode(self, node):
-        for endFilter in self.endElementFilters:
-            node = endFilter.testElement("node", node)
-        
-        self.datastore.addNode(node)
-        self.nodeCount += 1
+    def parsedNodes(self, nodes):
+        nodes = self.filterChain.applyBatch("node", nodes)
+        for node in nodes:
+            if self.tagPool is not None:
+                node.tags = self.tagPool.intern(node.tags)
+            self.datastore.addNode(node)
+        self.nodeCount += len(nodes)
+    
+    def parsedNodeBlock(self, ids, lons, lats, tags):
+        """Hand a decoded DenseNodes group to the datastore in one call. Only the
+        tagged nodes are run through the endElementFilters."""
+        if tags and self.filterChain.wants("node"):
+            nodes = [Node(int(ids[i]), (float(lons[i]), float(lats[i])), nodeTags) for i,nodeTags in tags.iteritems()]
+            positions = tags.keys()
+            nodes = self.filterChain.applyBatch("node", nodes)
+            tags = {}
+            for i,node in zip(positions, nodes):
+                if node.tags:
+                    tags[i] = node.tags
         
-    def parsedWay(self, way):
-        for endFilter in self.endElementFilters:
-            way = endFilter.testElement("way", way)
+        if self.tagPool is not None:
+            intern = self.tagPool.intern
+            for i,nodeTags in tags.iteritems():
+                tags[i] = intern(nodeTags)
+            self.tagPool.countEmpty(len(ids) - len(tags))
         
-        self.datastore.addWay(way)
-        self.wayCount += 1
+        self.datastore.addNodeBlock(ids, lons, lats, tags)
+        self.nodeCount += len(ids)
         
-    def parsedRelation(self, rel):
-        for endFilter in self.endElementFilters:
-            rel = endFilter.testElement("relation", rel)
+    def parsedWays(self, ways):
+        ways = self.filterChain.applyBatch("way", ways)
+        for way in ways:
+            if self.tagPool is not None:
+                way.tags = self.tagPool.intern(way.tags)
+            self.datastore.addWay(way)
+        self.wayCount += len(ways)
         
-        self.datastore.addRelation(rel)
-        self.relCount += 1
-    
\ No newline at end of file
+    def parsedRelations(self, rels):
+        rels = self.filterChain.applyBatch("relation", rels)
+        for rel in rels:
+            if self.tagPool is not None:
+                rel.tags = self.tagPool.intern(rel.tags)
+            self.datastore.addRelation(rel)
+        self.relCount += len(rels)
@@ -0,0 +1,146 @@
+#
+#  osm2spatialite
+#  Copyright (C) 2011 Daniel Sabo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from OSMIdSet import IdBitSet
+
+class WayNodeCollector():
+    """A datastore that only records which node ids are referenced by ways,
+    used for a first pass over the input"""
+    def __init__(self):
+        self.nodeIds = IdBitSet()
+
+    def commit(self):
+        pass
+
+    def cleanup(self):
+        pass
+
+    def addNode(self, object):
+        pass
+
+    def addNodeBlock(self, ids, lons, lats, tags):
+        pass
+
+    def addWay(self, object):
+        self.nodeIds.addMany(object.nodes)
+
+    def addRelation(self, object):
+        pass
+
+class OSMPrunedNodeStore():
+    """A datastore that drops nodes that are neither tagged nor in
+    neededNodes (an IdBitSet, usually the nodes referenced by ways) and
+    passes everything else on to another datastore"""
+    def __init__(self, datastore, neededNodes):
+        self.datastore = datastore
+        self.neededNodes = neededNodes
+        self.dropped = 0
+
+    def commit(self):
+        self.datastore.commit()
+
+    def cleanup(self):
+        self.datastore.cleanup()
+
+    # "Add" functions
+    def addNode(self, object):
+        if object.tags or object.id in self.neededNodes:
+            self.datastore.addNode(object)
+        else:
+            self.dropped += 1
+
+    def addNodeBlock(self, ids, lons, lats, tags):
+        keep = self.neededNodes.containsMany(ids)
+        for i in tags:
+            keep[i] = True
+
+        if isinstance(keep, list):
+            positions = [i for i in xrange(len(ids)) if keep[i]]
+            if len(positions) < len(ids):
+                newPositions = dict((i, n) for n,i in enumerate(positions))
+                tags = dict((newPositions[i], nodeTags) for i,nodeTags in tags.iteritems())
+                ids  = [ids[i] for i in positions]
+                lons = [lons[i] for i in positions]
+                lats = [lats[i] for i in positions]
+        else:
+            positions = numpy.flatnonzero(keep)
+            if len(positions) < len(ids):
+                newPositions = numpy.cumsum(keep) - 1
+                tags = dict((int(newPositions[i]), nodeTags) for i,nodeTags in tags.iteritems())
+                ids  = numpy.asarray(ids)[positions]
+                lons = numpy.asarray(lons)[positions]
+                lats = numpy.asarray(lats)[positions]
+
+        self.dropped += len(keep) - len(positions)
+        if len(ids):
+            self.datastore.addNodeBlock(ids, lons, lats, tags)
+
+    def addWay(self, object):
+        self.datastore.addWay(object)
+
+    def addRelation(self, object):
+        self.datastore.addRelation(object)
+
+    # "Delete" functions
+    def delWays(self, osm_ids):
+        self.datastore.delWays(osm_ids)
+
+    # "Iteration" functions
+    def getNodesIter(self):
+        return self.datastore.getNodesIter()
+
+    def getWaysIter(self):
+        return self.datastore.getWaysIter()
+
+    def getRelationsIter(self):
+        return self.datastore.getRelationsIter()
+
+    # Count data length
+    def getNumNodes(self):
+        return self.datastore.getNumNodes()
+    def getNumWays(self):
+        return self.datastore.getNumWays()
+    def getNumRelations(self):
+        return self.datastore.getNumRelations()
+
+    # "Get" functions
+    def getNode(self, osm_id):
+        return self.datastore.getNode(osm_id)
+
+    def getNodes(self, osm_ids):
+        return self.datastore.getNodes(osm_ids)
+
+    def getNodePoints(self, osm_ids):
+        return self.datastore.getNodePoints(osm_ids)
+
+    def getWay(self, osm_id):
+        return self.datastore.getWay(osm_id)
+
+    def getWays(self, osm_ids):
+        return self.datastore.getWays(osm_ids)
+
+    def getRelation(self, osm_id):
+        return self.datastore.getRelation(osm_id)
+
+    def getRelations(self, osm_ids):
+        return self.datastore.getRelations(osm_ids)
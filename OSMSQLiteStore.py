@@ -16,8 +16,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import cPickle
 import math
+import os
+import collections
+import OSMObjectCodec
+from OSMElements import Node
 
 try:
     # Use the KyngChaos sqlite3 if it's available, otherwise try the standard one
@@ -26,8 +29,15 @@ except ImportError:
     import sqlite3 as sqlite 
 
 class OSMSQLiteStore():
-    def __init__(self, db):
-        if db == None:
+    def __init__(self, filename, cacheSize=256, mmapSize=1024, prefetch=0, prefetchPages=16, overwrite=False):
+        """filename: The scratch database, it's created and deleted again by cleanup()
+        overwrite: Replace filename if it exists, otherwise that's an error
+        cacheSize: The SQLite page cache in MB
+        mmapSize: How much of the scratch database SQLite may memory map, in MB
+        prefetch: If set, node lookups fetch the whole range of this many ids
+        around the requested node with one query and keep it for later lookups
+        prefetchPages: How many of those ranges are kept"""
+        if filename == None:
             raise
 
         self.ways  = {}
@@ -38,11 +48,33 @@ class OSMSQLiteStore():
         self.numways = 0
         self.numrelations = 0
 
-        self.db = db
+        self.filename = filename
+        if os.path.exists(filename):
+            if not overwrite:
+                raise IOError("Scratch database %s already exists" % filename)
+            os.unlink(filename)
+        self.db = sqlite.connect(filename)
         self.cursor = None
+        
+        # Objects are stored in a compact binary format, see OSMObjectCodec
+        self.codec = OSMObjectCodec.OSMObjectCodec()
+        
+        # Recently fetched node id ranges, page number -> {id: object}
+        self.prefetch = prefetch
+        self.prefetchPages = prefetchPages
+        self.pages = collections.OrderedDict()
 
         if self.db != None:
-            self.cursor = db.cursor()
+            self.cursor = self.db.cursor()
+
+        # The scratch database is thrown away after the import, so it
+        # doesn't need to survive crashes
+        self.cursor.execute("PRAGMA journal_mode=OFF;")
+        self.cursor.execute("PRAGMA synchronous=OFF;")
+        self.cursor.execute("PRAGMA locking_mode=EXCLUSIVE;")
+        self.cursor.execute("PRAGMA temp_store=MEMORY;")
+        self.cursor.execute("PRAGMA cache_size=%d;" % (-cacheSize * 1024))
+        self.cursor.execute("PRAGMA mmap_size=%d;" % (mmapSize * 1024 * 1024))
 
         # init database for temporary storage
         self.cursor.execute("DROP TABLE IF EXISTS \"tmpNodes\";")
@@ -53,6 +85,8 @@ class OSMSQLiteStore():
         self.cursor.execute("CREATE TABLE \"tmpRels\" (\"id\" INTEGER PRIMARY KEY NOT NULL, \"object\" BLOB);")  
         
     def commit(self):
+        self.pages.clear()
+        
         # save nodes
         self.cursor.executemany("insert into \"tmpNodes\" values (?,?)", self.nodes.iteritems() )
         self.nodes.clear()
@@ -74,24 +108,18 @@ class OSMSQLiteStore():
         self.db.commit()
         
     def cleanup(self):
-        # drop temporary tables
-        self.cursor.execute("DROP TABLE IF EXISTS \"tmpNodes\";")
-        self.cursor.execute("DROP TABLE IF EXISTS \"tmpWays\";")
-        self.cursor.execute("DROP TABLE IF EXISTS \"tmpRels\";")
-        
-        # speedup database
-        self.db.commit()
-        self.cursor.execute("ANALYZE")
-        self.db.commit()
-        self.cursor.execute("VACUUM")
-        self.db.commit()
+        # the scratch database is simply deleted
         self.cursor.close()
+        self.db.close()
+        os.unlink(self.filename)
             
     
     # "Add" functions
     def addNode(self, object):
+        if self.pages:
+            self.pages.clear()
         self.numnodes += 1
-        self.nodes[object["id"]] = sqlite.Binary(cPickle.dumps(object, cPickle.HIGHEST_PROTOCOL))
+        self.nodes[object.id] = sqlite.Binary(self.codec.encodeNode(object))
         
         if self.numnodes % 250001 >= 250000:
             self.cursor.executemany("insert into \"tmpNodes\" values (?,?)", self.nodes.iteritems() )
@@ -100,9 +128,13 @@ class OSMSQLiteStore():
             del self.nodes
             self.nodes = {}
     
+    def addNodeBlock(self, ids, lons, lats, tags):
+        for i in xrange(len(ids)):
+            self.addNode(Node(int(ids[i]), (float(lons[i]), float(lats[i])), tags.get(i, {})))
+    
     def addWay(self, object):
         self.numways += 1
-        self.ways[object["id"]] = sqlite.Binary(cPickle.dumps(object, cPickle.HIGHEST_PROTOCOL))
+        self.ways[object.id] = sqlite.Binary(self.codec.encodeWay(object))
         
         if self.numways % 250001 >= 250000:
             self.cursor.executemany("insert into \"tmpWays\" values (?,?)", self.ways.iteritems() )
@@ -113,7 +145,7 @@ class OSMSQLiteStore():
     
     def addRelation(self, object):
         self.numrelations += 1
-        self.relations[object["id"]] = sqlite.Binary(cPickle.dumps(object, cPickle.HIGHEST_PROTOCOL))
+        self.relations[object.id] = sqlite.Binary(self.codec.encodeRelation(object))
         
         if self.numrelations % 250001 >= 250000:
             self.cursor.executemany("insert into \"tmpRels\" values (?,?)", self.relations.iteritems() )
@@ -142,23 +174,23 @@ class OSMSQLiteStore():
     # "Iteration" functions to browse through all data
     def getNodesIter(self):
         cur = self.db.cursor()
-        cur.execute("SELECT object FROM \"tmpNodes\";")
+        cur.execute("SELECT id, object FROM \"tmpNodes\";")
         for row in cur:
-            yield cPickle.loads(str(row[0]))
+            yield self.codec.decodeNode(row[0], row[1])
         cur.close()
         
     def getWaysIter(self):
         cur = self.db.cursor()
-        cur.execute("SELECT object FROM \"tmpWays\";")
+        cur.execute("SELECT id, object FROM \"tmpWays\";")
         for row in cur:
-            yield cPickle.loads(str(row[0]))
+            yield self.codec.decodeWay(row[0], row[1])
         cur.close()
         
     def getRelationsIter(self):
         cur = self.db.cursor()
-        cur.execute("SELECT object FROM \"tmpRels\";")
+        cur.execute("SELECT id, object FROM \"tmpRels\";")
         for row in cur:
-            yield cPickle.loads(str(row[0]))
+            yield self.codec.decodeRelation(row[0], row[1])
         cur.close()
         
     # Count data length
@@ -170,27 +202,100 @@ class OSMSQLiteStore():
         return self.numrelations
     
     # "Get" functions
-    def _get(self, sql, osm_id):
+    def _get(self, sql, osm_id, decode):
         cur = self.db.cursor()  
         try:
             cur.execute(sql, [osm_id])
             row = cur.fetchone()
             cur.close()           
             if row is not None:
-                return cPickle.loads(str(row[0]))
+                return decode(osm_id, row[0])
             else:
                 return None
         except sqlite.Error, e:
             cur.close()
             return None
     
+    def _getMany(self, table, osm_ids, decode):
+        """Fetch many rows with as few queries as possible, returns a dict of
+        id -> decode(id, object) for the ids that were found"""
+        osm_ids = list(set(osm_ids))
+        result = {}
+        cur = self.db.cursor()
+        try:
+            # Stay below the 999 arguments limit of SQLite
+            for start in xrange(0, len(osm_ids), 999):
+                chunk = osm_ids[start:start + 999]
+                sql = "SELECT id, object FROM \"%s\" WHERE id IN (%s);" % (table, ','.join(['?'] * len(chunk)))
+                for row in cur.execute(sql, chunk):
+                    result[row[0]] = decode(row[0], row[1])
+        except sqlite.Error, e:
+            pass
+        cur.close()
+        return result
+    
+    def _getNodePage(self, page):
+        """Return the {id: object} of all nodes in the prefetch range page"""
+        try:
+            rows = self.pages.pop(page)
+        except KeyError:
+            start = page * self.prefetch
+            cur = self.db.cursor()
+            cur.execute("SELECT id, object FROM \"tmpNodes\" WHERE id BETWEEN ? AND ?;", [start, start + self.prefetch - 1])
+            rows = dict(cur)
+            cur.close()
+            if len(self.pages) >= self.prefetchPages:
+                self.pages.popitem(last=False)
+        self.pages[page] = rows
+        return rows
+    
+    def _getPrefetchedNodes(self, osm_ids, decode):
+        result = {}
+        prefetch = self.prefetch
+        lastPage = None
+        rows = None
+        for osm_id in osm_ids:
+            page = osm_id // prefetch
+            if page != lastPage:
+                rows = self._getNodePage(page)
+                lastPage = page
+            data = rows.get(osm_id)
+            if data is not None:
+                result[osm_id] = decode(osm_id, data)
+        return result
+    
     def getNode(self, osm_id):
-        return self._get("SELECT object FROM \"tmpNodes\" WHERE id=?;", osm_id)
+        if self.prefetch:
+            data = self._getNodePage(osm_id // self.prefetch).get(osm_id)
+            if data is None:
+                return None
+            return self.codec.decodeNode(osm_id, data)
+        return self._get("SELECT object FROM \"tmpNodes\" WHERE id=?;", osm_id, self.codec.decodeNode)
+    
+    def getNodes(self, osm_ids):
+        if self.prefetch:
+            return self._getPrefetchedNodes(osm_ids, self.codec.decodeNode)
+        return self._getMany("tmpNodes", osm_ids, self.codec.decodeNode)
+    
+    def getNodePoints(self, osm_ids):
+        """Return the [lon, lat] of each of osm_ids, None for missing nodes"""
+        decode = lambda osm_id, data: self.codec.decodeNodePoint(data)
+        if self.prefetch:
+            points = self._getPrefetchedNodes(osm_ids, decode)
+        else:
+            points = self._getMany("tmpNodes", osm_ids, decode)
+        return [points.get(osm_id) for osm_id in osm_ids]
         
     def getWay(self, osm_id):
-        return self._get("SELECT object FROM \"tmpWays\" WHERE id=?;", osm_id)
+        return self._get("SELECT object FROM \"tmpWays\" WHERE id=?;", osm_id, self.codec.decodeWay)
+    
+    def getWays(self, osm_ids):
+        return self._getMany("tmpWays", osm_ids, self.codec.decodeWay)
         
     def getRelation(self, osm_id):
-        return self._get("SELECT object FROM \"tmpRels\" WHERE id=?;", osm_id)
+        return self._get("SELECT object FROM \"tmpRels\" WHERE id=?;", osm_id, self.codec.decodeRelation)
+    
+    def getRelations(self, osm_ids):
+        return self._getMany("tmpRels", osm_ids, self.codec.decodeRelation)
 
         
@@ -0,0 +1,68 @@
+#
+#  osm2spatialite
+#  Copyright (C) 2011 Daniel Sabo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+class FrozenTags(dict):
+    """An immutable, hashable tag dict that can be shared by many objects.
+    Code that wants to change the tags of an object has to replace them
+    with a copy, e.g. object.tags = dict(object.tags)"""
+    __slots__ = ("hash",)
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.hash = hash(frozenset(self.iteritems()))
+
+    def __hash__(self):
+        return self.hash
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("FrozenTags can't be changed, copy them first")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return (FrozenTags, (dict(self),))
+
+# The tags of all untagged objects
+EMPTY_TAGS = FrozenTags()
+
+class TagSetPool():
+    """Map every distinct tag set to one shared FrozenTags"""
+    def __init__(self):
+        self.pool = {EMPTY_TAGS:EMPTY_TAGS}
+        self.seen = 0
+
+    def intern(self, tags):
+        """Return the shared FrozenTags equal to tags"""
+        self.seen += 1
+        if not tags:
+            return EMPTY_TAGS
+        if type(tags) is not FrozenTags:
+            tags = FrozenTags(tags)
+        return self.pool.setdefault(tags, tags)
+
+    def countEmpty(self, count):
+        """Count untagged objects that didn't go through intern()"""
+        self.seen += count
+
+    def getStats(self):
+        """Return a dict with the number of tag sets interned ("seen") and
+        how many of them were distinct ("distinct")"""
+        return {"seen":self.seen, "distinct":len(self.pool)}
+
+    def __len__(self):
+        return len(self.pool)
@@ -0,0 +1,67 @@
+#
+#  osm2spatialite
+#  Copyright (C) 2011 Daniel Sabo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import itertools
+from array import array
+
+from OSMCachedStore import LRUCache
+
+# Rough memory use of a cached line in bytes: the array header plus two
+# doubles per point
+LINE_SIZE  = 100
+POINT_SIZE = 16
+
+class WayGeometryCache():
+    """An LRU cache of composed way lines. Each line is kept as one flat
+    array of doubles (lon, lat, lon, lat, ...) instead of a list of point
+    tuples, which is about a fifth of the memory."""
+    def __init__(self, maxEntries=None, maxMB=None):
+        """maxEntries: Maximum number of cached lines
+        maxMB: Maximum memory use of the cached lines in MB"""
+        maxBytes = None
+        if maxMB is not None:
+            maxBytes = maxMB * 1024 * 1024
+        self.cache = LRUCache(maxEntries, maxBytes)
+
+    def get(self, osm_id):
+        """Return a new list of the [lon, lat] points of a cached line, or
+        None if the way isn't cached"""
+        coords = self.cache.get(osm_id)
+        if coords is None:
+            return None
+        return [list(point) for point in zip(coords[0::2], coords[1::2])]
+
+    def take(self, osm_id):
+        """Like get, but also drop the line from the cache, for ways that
+        won't be needed again"""
+        line = self.get(osm_id)
+        if line is not None:
+            self.cache.discard(osm_id)
+        return line
+
+    def put(self, osm_id, line):
+        coords = array("d", itertools.chain.from_iterable(line))
+        self.cache.put(osm_id, coords, LINE_SIZE + POINT_SIZE * len(line))
+
+    def getStats(self):
+        """Return a dict of cache counters"""
+        return {"entries":len(self.cache), "bytes":self.cache.bytes,
+                "hits":self.cache.hits, "misses":self.cache.misses, "evictions":self.cache.evictions}
+
+    def clear(self):
+        self.cache.clear()
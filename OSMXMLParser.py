@@ -17,15 +17,28 @@
 #
 
 import xml.sax, xml.sax.handler
-import array
+from OSMElements import Node, Way, Relation, Member, refArray
+from OSMFilterChain import FilterChain
 
 class OSMXMLParser(xml.sax.handler.ContentHandler):
     def __init__(self):
         xml.sax.handler.ContentHandler.__init__(self)
         self.endElementFilters = []
+        
+        # If set, the tags of every object are replaced by the shared
+        # copy from this OSMTagPool.TagSetPool after the filters ran
+        self.tagPool = None
+        
+        # If set, only tags with these keys are kept
+        self.keepTags = None
+        
+        # Keep the time spent in each endElementFilter, see OSMFilterChain
+        self.filterTiming = False
+        self.filterChain = None
 
     def parse(self, filename, datastore):
         self.datastore = datastore
+        self.filterChain = FilterChain(self.endElementFilters, self.filterTiming)
         f = open(filename)
         try:
             xml.sax.parse(f, self)
@@ -52,22 +65,25 @@ class OSMXMLParser(xml.sax.handler.ContentHandler):
         if self.currentObject:
             try:
                 if name == "member":
-                    member = {
-                        "type":intern(str(attrs.getValue("type"))),
-                        "ref":int(attrs.getValue("ref")),
-                        "role":intern(str(attrs.getValue("role"))),
-                    }
-                    self.currentObject["members"].append(member)
+                    member = Member(
+                        intern(str(attrs.getValue("type"))),
+                        int(attrs.getValue("ref")),
+                        intern(str(attrs.getValue("role"))),
+                    )
+                    self.currentObject.members.append(member)
                 elif name == "nd":
-                    self.currentObject["nodes"].append(int(attrs.getValue("ref")))
+                    self.currentObject.nodes.append(int(attrs.getValue("ref")))
                 elif name == "tag":
-                    key = intern(str(attrs.getValue("k")))
+                    key = attrs.getValue("k")
+                    if self.keepTags is not None and key not in self.keepTags:
+                        return
+                    key = intern(str(key))
                     value = attrs.getValue("v")
                     try:
                         value = intern(str(value))
                     except UnicodeEncodeError:
                         pass
-                    self.currentObject["tags"][key] = value
+                    self.currentObject.tags[key] = value
             except:
                 import traceback
                 traceback.print_exc()
@@ -78,48 +94,53 @@ class OSMXMLParser(xml.sax.handler.ContentHandler):
                 version = int(attrs.getValue("version"))
             except KeyError:
                 version = -1
-            self.currentObject = {
-                "tags":{},
-                "point":array.array('d',[float(attrs.getValue("lon")),float(attrs.getValue("lat"))]),
-                "id":int(attrs.getValue("id")),
-                "version":version
-            }
+            self.currentObject = Node(
+                int(attrs.getValue("id")),
+                (float(attrs.getValue("lon")),float(attrs.getValue("lat"))),
+                {},
+                version
+            )
         elif name == "way":
             try:
                 version = int(attrs.getValue("version"))
             except KeyError:
                 version = -1
-            self.currentObject = {
-                "tags":{},
-                "nodes":[],
-                "id":int(attrs.getValue("id")),
-                "version":version
-            }
+            self.currentObject = Way(
+                int(attrs.getValue("id")),
+                [],
+                {},
+                version
+            )
         elif name == "relation":
             try:
                 version = int(attrs.getValue("version"))
             except KeyError:
                 version = -1
-            self.currentObject = {
-                "tags":{},
-                "members":[],
-                "id":int(attrs.getValue("id")),
-                "version":version
-            }
+            self.currentObject = Relation(
+                int(attrs.getValue("id")),
+                [],
+                {},
+                version
+            )
     
     def endElement(self, name):
         if not self.currentObject:
             return
         
-        for endFilter in self.endElementFilters:
-            self.currentObject = endFilter.testElement(name, self.currentObject)
+        if name not in ("node", "way", "relation"):
+            return
+        
+        self.currentObject = self.filterChain.apply(name, self.currentObject)
+        
+        if self.tagPool is not None:
+            self.currentObject.tags = self.tagPool.intern(self.currentObject.tags)
         
         if name == "node":
             self.datastore.addNode(self.currentObject)
             self.nodeCount += 1
             self.currentObject = None
         elif name == "way":
-            self.currentObject["nodes"] = array.array('i', self.currentObject["nodes"])
+            self.currentObject.nodes = refArray(self.currentObject.nodes)
             self.datastore.addWay(self.currentObject)
             self.wayCount += 1
             self.currentObject = None
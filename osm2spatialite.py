@@ -27,7 +27,9 @@ import platform
 import copy
 import array
 import ctypes.util
-import OSMXMLParser, OSMMemStore, OSMSQLiteStore
+import multiprocessing
+import OSMTagPool, OSMPrunedNodeStore, OSMIdSet, OSMWayGeometryCache
+import OSMXMLParser, OSMMemStore, OSMSQLiteStore, OSMNodeLocationStore, OSMCachedStore, OSMColumnStore
 
 # The following is a hack to avoid unicode errors when printing errors:
 import sys
@@ -62,6 +64,26 @@ except OSError:
     else:
         raise
 
+try:
+    from shapely.prepared import prep
+except ImportError:
+    prep = None
+
+try:
+    from shapely.strtree import STRtree
+except ImportError:
+    STRtree = None
+
+# Multipolygons with fewer rings than this don't use an STRtree to find
+# the rings that may contain each other
+STRTREE_MIN_RINGS = 16
+
+# Multipolygons are sent to the polygonize workers in batches of at most
+# this many vertices (relations bigger than that go on their own), or less
+# if that would leave workers idle
+POLYGONIZE_BATCH_VERTICES = 100000
+POLYGONIZE_MIN_BATCH_VERTICES = 1000
+
 try:
     # Use the KyngChaos sqlite3 if it's available, otherwise try the standard one
     from pysqlite2 import dbapi2 as sqlite
@@ -112,40 +134,45 @@ def polyWinding(poly):
     #a = a / 2.0
     return bool(a > 0)
         
-def composeWay(datastore,way):
-    """Compose a line from it's node refs into an array of coordinates"""
-    line = []            
-    for nodeRef in way["nodes"]:
-        node = datastore.getNode(nodeRef)
-        if node is not None:
-            line.append(node["point"])
-        else:
-            reportWarning("Way %s is incomplete!" % (str(way["id"])))
-            line = None
-            break
+def composeWay(datastore,way,wayCache=None):
+    """Compose a line from it's node refs into an array of coordinates,
+    wayCache: A WayGeometryCache to look the line up in and add it to"""
+    if wayCache is not None:
+        line = wayCache.get(way.id)
+        if line is not None:
+            return line
+    line = datastore.getNodePoints(way.nodes)
+    if None in line:
+        reportWarning("Way %s is incomplete!" % (str(way.id)))
+        line = None
     if not line:
-        reportWarning("Way %s has no nodes!" % (str(way["id"])))
+        reportWarning("Way %s has no nodes!" % (str(way.id)))
         return None
     elif len(line) <= 1:
-        reportWarning("Way %s only one node!" % (str(way["id"])))
+        reportWarning("Way %s only one node!" % (str(way.id)))
         return None
+    if wayCache is not None:
+        wayCache.put(way.id, line)
     return line
 
 # not used at the moment
 def composeWays(datastore):
-    """Compose all ways"""
+    """Compose all ways, returns a dict of way id -> line"""
     incompleteCount = 0
+    lines = {}
     for way in datastore.getWaysIter():
         line = composeWay(datastore, way)
         if not line:
-            reportWarning("Way %s is incomplete!" % (str(way["id"])))
+            reportWarning("Way %s is incomplete!" % (str(way.id)))
             incompleteCount += 1
-        way["line"] = line
+        lines[way.id] = line
     if incompleteCount > 0:
         reportWarning("%s incomplete ways!" % (str(incompleteCount)))
+    return lines
 
-def composeMultipolygons(datastore):
-    """Compose the line segments that make up a multipolygon into closed rings"""
+def composeMultipolygons(datastore, wayCache=None):
+    """Compose the line segments that make up a multipolygon into closed rings,
+    returns a list of (relation, rings)"""
     incompleteCount = 0
     
     multipolygons = []
@@ -154,97 +181,103 @@ def composeMultipolygons(datastore):
         outerLines = []
         innerLines = []
         
-        for member in relation["members"]:
-            if member["type"] == "way":
-                way = datastore.getWay(member["ref"])
+        ways = datastore.getWays([member.ref for member in relation.members if member.type == "way"])
+        for member in relation.members:
+            if member.type == "way":
+                way = ways.get(member.ref)
                 if way is not None:
-                    if member["role"] == "outer":
+                    if member.role == "outer":
                         outerLines.append(way)
-                    elif member["role"] == "inner":
+                    elif member.role == "inner":
                         innerLines.append(way)
                 else:
                     return None
         
         name = None
-        if "name" in relation["tags"]:
-            name = relation["tags"]["name"]
+        if "name" in relation.tags:
+            name = relation.tags["name"]
         #print "Composing relation \"%s\" from %d lines" % (name, len(outerLines) + len(innerLines))
         
         def composeLoops(lines):
+            # Endpoint node id -> the ways that start or end there, a closed
+            # way is in the list twice. A list is only as long as the number
+            # of ways meeting at the node (usually two), so removing a way
+            # from it is cheap.
             endpoints = {}
             for way in lines:
-                line = composeWay(datastore, way)
+                line = composeWay(datastore, way, wayCache)
                 if line == None:
-                    reportWarning("Multipolygon (%d) contains an incomplete way! (%d)" % (id, way["id"]))
+                    reportWarning("Multipolygon (%d) contains an incomplete way! (%d)" % (id, way.id))
                     return None
-                start = way["nodes"][0]
-                end   = way["nodes"][-1]
-            
-                for point in [start,end]:
-                    if point in endpoints:
-                        endpoints[point].append(way)
-                    else:
+                for point in (way.nodes[0], way.nodes[-1]):
+                    ways = endpoints.get(point)
+                    if ways is None:
                         endpoints[point] = [way]
+                    else:
+                        ways.append(way)
                         
-            for ways in endpoints.values():
+            for ways in endpoints.itervalues():
                 if len(ways) % 2 != 0:
                     reportWarning("Multipolygon (%d) has an unclosed ring!" % (id))
                     return None
             
             remainingEndpoints = copy.copy(endpoints)
+            # Endpoints are only ever removed from remainingEndpoints, so one
+            # pass over its keys finds the start point of every ring
+            startPoints = remainingEndpoints.keys()
+            nextStart = 0
                         
             composedLines = []
             while remainingEndpoints:
-                point,ways = remainingEndpoints.items()[0]
+                point = startPoints[nextStart]
+                if point not in remainingEndpoints:
+                    nextStart += 1
+                    continue
+                ways = remainingEndpoints[point]
                 lastWay = ways[0]
-                if lastWay["nodes"][0] == point:
-                    #line  = ways[0]["line"][:]
-                    line  = composeWay(datastore, ways[0])
-                    start = ways[0]["nodes"][0]
-                    end   = ways[0]["nodes"][-1]
-                    del remainingEndpoints[start][0]
-                    #del remainingEndpoints[start]
+                line = composeWay(datastore, lastWay, wayCache)
+                if lastWay.nodes[0] == point:
+                    start = lastWay.nodes[0]
+                    end   = lastWay.nodes[-1]
                 else:
-                    #line  = ways[0]["line"][:]
-                    line  = composeWay(datastore, ways[0])
                     line.reverse()
-                    start = ways[0]["nodes"][-1]
-                    end   = ways[0]["nodes"][0]
-                    del remainingEndpoints[start][0]
-                    #del remainingEndpoints[start]
+                    start = lastWay.nodes[-1]
+                    end   = lastWay.nodes[0]
+                del ways[0]
                 
                 while end != start:
                     # Find our next line:
-                    ways = endpoints[end]
-                    nextWay = None
-                    if ways[0] != lastWay:
+                    ways = remainingEndpoints[end]
+                    if ways[0] is not lastWay:
                         nextWay = ways[0]
                     else:
                         nextWay = ways[1]
                         
                     # find out which end they connect at
-                    #nextLine = nextWay["line"][:]
-                    nextLine  = composeWay(datastore, nextWay)
-                    newEnd = nextWay["nodes"][-1]
-                    if nextWay["nodes"][0] != end:
-                        # start to start, flip the new line
-                        nextLine.reverse()
-                        newEnd = nextWay["nodes"][0]
-                    line.extend(nextLine[1:])
+                    nextLine  = composeWay(datastore, nextWay, wayCache)
+                    if nextWay.nodes[0] == end:
+                        line.extend(nextLine[1:])
+                        newEnd = nextWay.nodes[-1]
+                    else:
+                        # end to end, append the new line backwards
+                        line.extend(nextLine[-2::-1])
+                        newEnd = nextWay.nodes[0]
                     
-                    del remainingEndpoints[end][remainingEndpoints[end].index(nextWay)]
-                    del remainingEndpoints[end][remainingEndpoints[end].index(lastWay)]
-                    if not remainingEndpoints[end]:
+                    ways.remove(nextWay)
+                    ways.remove(lastWay)
+                    if not ways:
                         del remainingEndpoints[end]
-                    #del remainingEndpoints[end]
                     
                     end = newEnd
                     lastWay = nextWay
-                del remainingEndpoints[end][remainingEndpoints[end].index(lastWay)]
-                if not remainingEndpoints[end]:
+                ways = remainingEndpoints[end]
+                ways.remove(lastWay)
+                if not ways:
                     del remainingEndpoints[end]
                 
-                if line[0] == line[-1]:
+                # Stores return points as tuples or lists, and cached and
+                # uncached lines can be mixed in one ring
+                if tuple(line[0]) == tuple(line[-1]):
                     composedLines.append(line)
                 else:
                     reportWarning("Multipolygon (%d) ring is not closed!" % (id))
@@ -268,46 +301,76 @@ def composeMultipolygons(datastore):
         return outerRings
     
     for relation in datastore.getRelationsIter():
-        if "type" in relation["tags"] and (relation["tags"]["type"] == "multipolygon" or relation["tags"]["type"] == "boundary"):
-            result = composeMultipolygon(relation["id"],relation)
+        if "type" in relation.tags and (relation.tags["type"] == "multipolygon" or relation.tags["type"] == "boundary"):
+            result = composeMultipolygon(relation.id,relation)
             if not result:
                 name = None
-                if "name" in relation["tags"]:
-                    name = relation["tags"]["name"]
-                reportWarning("Relation \"%s\" (%d) is incomplete!" % (name,relation["id"]))
+                if "name" in relation.tags:
+                    name = relation.tags["name"]
+                reportWarning("Relation \"%s\" (%d) is incomplete!" % (name,relation.id))
                 incompleteCount += 1
             else:
-                multipolygons.append(relation)
-                relation["composed"] = result
+                multipolygons.append((relation, result))
                 
     if incompleteCount:
         print incompleteCount,"incomplete relations!"
     
     return multipolygons
 
+def ringContainers(polys):
+    """For each of a list of Shapely polygons find the other polygons that
+    contain it, returns a list of sets of indexes into polys. Polygons with
+    the same coordinates don't count as containing each other."""
+    containers = [set() for poly in polys]
+    bounds = [poly.bounds for poly in polys]
+    
+    if STRtree is not None and len(polys) >= STRTREE_MIN_RINGS:
+        tree = STRtree(polys)
+        polyIndex = dict((id(poly), i) for i,poly in enumerate(polys))
+        candidates = lambda poly: [polyIndex[id(tpoly)] for tpoly in tree.query(poly)]
+    else:
+        everything = range(len(polys))
+        candidates = lambda poly: everything
+    
+    for i,poly in enumerate(polys):
+        minx, miny, maxx, maxy = bounds[i]
+        prepared = None
+        for j in candidates(poly):
+            if j == i:
+                continue
+            # A polygon can only contain polygons inside its bounding box
+            tminx, tminy, tmaxx, tmaxy = bounds[j]
+            if tminx < minx or tminy < miny or tmaxx > maxx or tmaxy > maxy:
+                continue
+            if bounds[j] == bounds[i] and polys[j] == poly:
+                continue
+            if prepared is None:
+                prepared = prep(poly) if prep else poly
+            if prepared.contains(polys[j]):
+                containers[j].add(i)
+    return containers
+
 def shapelyPolygonizeMultipolygons(mpolys):
-    """Determine the nesting of multipolygon rings and build a Shapely multipolygon from them"""
+    """Determine the nesting of multipolygon rings and build a Shapely multipolygon from them,
+    mpolys is a list of (relation, rings), returns a list of (relation, shape)"""
     result = []
         
-    for mpoly_obj in mpolys:
-        mpoly = mpoly_obj["composed"]
+    for relation,mpoly in mpolys:
+        # Rings are referred to by their index in mpoly
+        polys = [Polygon(ring) for ring in mpoly]
+        containers = ringContainers(polys)
+        
+        # Outer ring -> [inner rings]
         polyTree = {}
         
         # For each ring, is it inside another ring?
-        polyList = []
-        polyMap = {}
-        for ring in mpoly:
-            poly = Polygon(ring)
-            polyMap[poly] = ring
-            polyList.append(poly)
+        polyList = range(len(polys))
         nextPass = []
         
         while polyList:
+            inPass = set(polyList)
             for poly in polyList:
-                withins = []
-                for tpoly in polyList:
-                    if tpoly != poly and tpoly.contains(poly):
-                        withins.append(tpoly)
+                withins = [tpoly for tpoly in containers[poly] if tpoly in inPass]
                         
                 # If a polygon is within more than one other polygon it must be nested, we'll have to do another pass to place it
                 if len(withins) == 0:
@@ -324,20 +387,76 @@ def shapelyPolygonizeMultipolygons(mpolys):
             nextPass = []
         
         mpolyList = []
-        for poly,inner in polyTree.items():
-            mlist = [poly.exterior.coords,[]]
+        for poly in sorted(polyTree):
+            mlist = [polys[poly].exterior.coords,[]]
              # Winding: This shouldn't be needed, but mapnik makes assumptions about winding
-            outerWinding = polyWinding(polyMap[poly])
-            for i in inner:
-                innerWinding = polyWinding(polyMap[i])
-                coords = polyMap[i][:]
+            outerWinding = polyWinding(mpoly[poly])
+            for i in polyTree[poly]:
+                innerWinding = polyWinding(mpoly[i])
+                coords = mpoly[i][:]
                 if outerWinding == innerWinding:
                     coords.reverse()
                 mlist[1].append(coords)
             mpolyList.append(mlist)
-        #FIXME: Not sure if this is a worthwhile optimization
-        del mpoly_obj["composed"]
-        mpoly_obj["shape"] = MultiPolygon(mpolyList)
+        result.append((relation, MultiPolygon(mpolyList)))
+    return result
+
+def polygonizeBatch(batch):
+    """Build the shapes of a list of (osm_id, tags, rings), returns a list
+    of (osm_id, tags, wkb)"""
+    result = []
+    for (osm_id,tags),shape in shapelyPolygonizeMultipolygons([((osm_id, tags), rings) for osm_id,tags,rings in batch]):
+        result.append((osm_id, tags, shape.wkb))
+    return result
+
+def polygonizeBatches(mpolys, maxVertices):
+    """Split a list of (relation, rings) into lists of (osm_id, tags, rings)
+    with at most maxVertices vertices, unless a single relation has more"""
+    batch = []
+    vertices = 0
+    for relation,rings in mpolys:
+        size = sum(len(ring) for ring in rings)
+        if batch and vertices + size > maxVertices:
+            yield batch
+            batch = []
+            vertices = 0
+        batch.append((relation.id, relation.tags, rings))
+        vertices += size
+    if batch:
+        yield batch
+
+def polygonizeMultipolygons(mpolys, workers=1):
+    """Build the shapes of a list of (relation, rings), yields (osm_id, tags, wkb)
+    in the same order. With more than one worker the shapes are built in a
+    pool of processes."""
+    if workers <= 1:
+        for batch in polygonizeBatches(mpolys, POLYGONIZE_BATCH_VERTICES):
+            for result in polygonizeBatch(batch):
+                yield result
+        return
+    
+    # Aim for a few batches per worker so a big relation doesn't hold up
+    # the others
+    vertices = sum(len(ring) for relation,rings in mpolys for ring in rings)
+    maxVertices = max(POLYGONIZE_MIN_BATCH_VERTICES, min(POLYGONIZE_BATCH_VERTICES, vertices // (workers * 4)))
+    batches = list(polygonizeBatches(mpolys, maxVertices))
+    if len(batches) < 2:
+        for batch in batches:
+            for result in polygonizeBatch(batch):
+                yield result
+        return
+    
+    pool = multiprocessing.Pool(workers)
+    try:
+        for results in pool.imap(polygonizeBatch, batches):
+            for result in results:
+                yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
 
 class AreaColector():
     """Find lines that represent valid simple areas"""
@@ -350,21 +469,44 @@ class AreaColector():
         }
         """
         self.areaTags = areaTags
-        self.areas = []
+        # The ids of the closed ways with area tags
+        self.areaIds = OSMIdSet.IdBitSet()
+        
+        # key -> None (any value) or the set of values that make an area
+        self.areaValues = {}
+        for key,values in areaTags.iteritems():
+            self.areaValues[key] = None if values is None else frozenset(values)
+    
+    elementTypes = ("way",)
+    
+    def isArea(self, tags):
+        """Check if tags has an area style tag"""
+        areaValues = self.areaValues
+        for key,value in tags.iteritems():
+            values = areaValues.get(key, False)
+            if values is None or (values and value in values):
+                return True
+        return False
+    
+    def isAreaWay(self, way):
+        """Check if way is closed and has an area style tag"""
+        nodes = way.nodes
+        return len(nodes) > 2 and nodes[0] == nodes[-1] and self.isArea(way.tags)
     
     def testElement(self, type, object):
         """type: A string representing the type of object being tested
         object: the object"""
-        if type == "way" and object["nodes"]:
-            # Is it closed?
-            if object["nodes"][0] == object["nodes"][-1] and len(object["nodes"]) > 2:
-                for key in self.areaTags.keys():
-                    # Check if it has an area style tag
-                    if key in object["tags"]:
-                        if self.areaTags[key] is None or object["tags"][key] in self.areaTags[key]:
-                            self.areas.append(object)
-                            break
+        if self.isAreaWay(object):
+            self.areaIds.add(object.id)
         return object
+    
+    def testElements(self, type, objects):
+        addArea = self.areaIds.add
+        isAreaWay = self.isAreaWay
+        for object in objects:
+            if isAreaWay(object):
+                addArea(object.id)
+        return objects
 
 class CopyTagValue():
     def __init__(self, fromtag, totag):
@@ -372,9 +514,57 @@ class CopyTagValue():
         self.totag   = totag
     
     def testElement(self, type, object):
-        if self.fromtag in object["tags"]:
-            object["tags"][self.totag] = object["tags"][self.fromtag]
+        if self.fromtag in object.tags:
+            if isinstance(object.tags, OSMTagPool.FrozenTags):
+                # Shared tags are copied before they're changed
+                object.tags = dict(object.tags)
+            object.tags[self.totag] = object.tags[self.fromtag]
+        return object
+
+class PointWriter():
+    """An endElementFilter that writes tagged nodes to world_point while the
+    file is parsed, in batches of batchSize. The tags of written nodes are
+    dropped, so the datastore only keeps their locations. It has to be
+    the last filter, and finish() must be called after parsing."""
+    elementTypes = ("node",)
+    
+    def __init__(self, db, tags, batchSize=10000):
+        self.cur = db.cursor()
+        self.tags = tags
+        self.batchSize = batchSize
+        self.rows = []
+        self.count = 0
+        self.sql = "INSERT INTO world_point(osm_id,way,%s) VALUES (?,GeomFromWKB(?,4326),%s)" % (
+            ','.join(['\"%s\"' % (x) for x in tags]), ','.join(['?'] * len(tags)))
+    
+    def testElement(self, type, object):
+        if type == "node" and object.tags:
+            point = Point(object.point)
+            self.rows.append([object.id, sqlite.Binary(point.wkb)] + [object.tags.get(tag) for tag in self.tags])
+            if len(self.rows) >= self.batchSize:
+                self.flush()
+            object.tags = OSMTagPool.EMPTY_TAGS
         return object
+    
+    def flush(self):
+        self.cur.executemany(self.sql, self.rows)
+        self.count += len(self.rows)
+        self.rows = []
+    
+    def finish(self):
+        self.flush()
+        self.cur.close()
+
+# Keys the import itself looks at besides the configured ones
+LOGIC_TAGS = ["type", "layer", "name"]
+
+def configTagKeys(config):
+    """The set of tag keys an import with config uses, other tags can be
+    dropped while parsing"""
+    keys = set(config["tags"])
+    keys.update(config["area_tags"].keys())
+    keys.update(LOGIC_TAGS)
+    return keys
 
 def initializeSqlite(db, tags):
     """Initialized an empty SpatiaLite database"""
@@ -424,75 +614,81 @@ def initializeSqlite(db, tags):
     
     return db
 
-def writeMpolysToSQLite(db, mpolys, tags):    
-    shapelyPolygonizeMultipolygons(mpolys)
-    
+def writeMpolysToSQLite(db, shapes, tags):
+    """shapes: (osm_id, tags, wkb) of each multipolygon, see polygonizeMultipolygons"""
     cur = db.cursor() 
-    for mpoly in mpolys:
-        cur.execute("INSERT INTO world_polygon(osm_id,osm_type,way) VALUES ((?),'R',GeomFromWKB((?),4326))", [mpoly["id"],sqlite.Binary(mpoly["shape"].wkb)])
+    for osm_id,mpolyTags,wkb in shapes:
+        cur.execute("INSERT INTO world_polygon(osm_id,osm_type,way) VALUES ((?),'R',GeomFromWKB((?),4326))", [osm_id,sqlite.Binary(wkb)])
         rowid = cur.lastrowid
         for tag in tags:
-            if tag in mpoly["tags"]:
+            if tag in mpolyTags:
                 sql = "UPDATE world_polygon SET \"%s\" = ? WHERE rowid == (?)" % (tag)
-                cur.execute(sql, [mpoly["tags"][tag], rowid])
+                cur.execute(sql, [mpolyTags[tag], rowid])
     cur.close()
     
-def writeSimpleAreasToSQLite(db, datastore, ac, tags):    
+def writeWaysToSQLite(db, datastore, areaIds, tags, wayCache=None):
+    """Write every tagged way as a simple area if its id is in areaIds (see
+    AreaColector), or as a line otherwise"""
     cur = db.cursor()
-    for area in ac.areas:
-        line = composeWay(datastore, area)
-        if not line or not area["tags"]:
-            continue
-        mpoly = MultiPolygon([[line,[]]])
-        cur.execute("INSERT INTO world_polygon(osm_id,osm_type,way) VALUES ((?),'W',GeomFromWKB((?),4326))", [area["id"], sqlite.Binary(mpoly.wkb)])
-        rowid = cur.lastrowid
-        sqlTags = []
-        sqlTagKeys = []
-        for tag in tags:
-            if tag in area["tags"]:
-                sqlTags.append(tag)
-                sqlTagKeys.append(area["tags"][tag])                
-        if len(sqlTagKeys) > 0:
-            sql = "UPDATE world_polygon SET %s WHERE rowid == (?)" % (','.join(['\"%s\" = ?' % (x) for x in sqlTags]))
-            sqlTagKeys.append(rowid)
-            cur.execute(sql, sqlTagKeys)
-    cur.close()
-
-def writeLinesToSQLite(db, datastore, tags):    
-    cur = db.cursor()  
     for way in datastore.getWaysIter():
-        line = composeWay(datastore, way)
-        if not way["tags"] or not line:
+        line = None
+        if wayCache is not None:
+            # Each way is only written once, so don't keep it around
+            line = wayCache.take(way.id)
+        if line is None:
+            line = composeWay(datastore, way)
+        if not line or not way.tags:
             continue
-        linestring = LineString(line)
-        cur.execute("INSERT INTO world_line(osm_id,way) VALUES ((?),GeomFromWKB((?),4326))", [way["id"],sqlite.Binary(linestring.wkb)])
-        rowid = cur.lastrowid
-        sqlTags = []
-        sqlTagKeys = []
-        for tag in tags:
-            if tag in way["tags"]:
-                sqlTags.append(tag)
-                sqlTagKeys.append(way["tags"][tag])    
-        if len(sqlTagKeys) > 0:
-            sql = "UPDATE world_line SET %s WHERE rowid == (?)" % (','.join(['\"%s\" = ?' % (x) for x in sqlTags]))
-            sqlTagKeys.append(rowid)
-            cur.execute(sql, sqlTagKeys)
+        if way.id in areaIds:
+            writeSimpleArea(cur, way, line, tags)
+        else:
+            writeLine(cur, way, line, tags)
     cur.close()
 
+def writeSimpleArea(cur, area, line, tags):
+    mpoly = MultiPolygon([[line,[]]])
+    cur.execute("INSERT INTO world_polygon(osm_id,osm_type,way) VALUES ((?),'W',GeomFromWKB((?),4326))", [area.id, sqlite.Binary(mpoly.wkb)])
+    rowid = cur.lastrowid
+    sqlTags = []
+    sqlTagKeys = []
+    for tag in tags:
+        if tag in area.tags:
+            sqlTags.append(tag)
+            sqlTagKeys.append(area.tags[tag])                
+    if len(sqlTagKeys) > 0:
+        sql = "UPDATE world_polygon SET %s WHERE rowid == (?)" % (','.join(['\"%s\" = ?' % (x) for x in sqlTags]))
+        sqlTagKeys.append(rowid)
+        cur.execute(sql, sqlTagKeys)
+
+def writeLine(cur, way, line, tags):
+    linestring = LineString(line)
+    cur.execute("INSERT INTO world_line(osm_id,way) VALUES ((?),GeomFromWKB((?),4326))", [way.id,sqlite.Binary(linestring.wkb)])
+    rowid = cur.lastrowid
+    sqlTags = []
+    sqlTagKeys = []
+    for tag in tags:
+        if tag in way.tags:
+            sqlTags.append(tag)
+            sqlTagKeys.append(way.tags[tag])    
+    if len(sqlTagKeys) > 0:
+        sql = "UPDATE world_line SET %s WHERE rowid == (?)" % (','.join(['\"%s\" = ?' % (x) for x in sqlTags]))
+        sqlTagKeys.append(rowid)
+        cur.execute(sql, sqlTagKeys)
+
 def writeNodesToSQLite(db, datastore, tags):
     cur = db.cursor()
     for node in datastore.getNodesIter():
-        if not node["tags"]:
+        if not node.tags:
             continue
-        point = Point(node["point"])
-        cur.execute("INSERT INTO world_point(osm_id,way) VALUES ((?),GeomFromWKB((?),4326))", [node["id"],sqlite.Binary(point.wkb)])
+        point = Point(node.point)
+        cur.execute("INSERT INTO world_point(osm_id,way) VALUES ((?),GeomFromWKB((?),4326))", [node.id,sqlite.Binary(point.wkb)])
         rowid = cur.lastrowid
         sqlTags = []
         sqlTagKeys = []
         for tag in tags:
-            if tag in node["tags"]:
+            if tag in node.tags:
                 sqlTags.append(tag)
-                sqlTagKeys.append(node["tags"][tag])  
+                sqlTagKeys.append(node.tags[tag])  
         if len(sqlTagKeys) > 0:
             sql = "UPDATE world_point SET %s WHERE rowid == (?)" % (','.join(['\"%s\" = ?' % (x) for x in sqlTags]))
             sqlTagKeys.append(rowid)
@@ -534,23 +730,81 @@ def sqlCreateIndexes(db):
     for table in ["polygon", "line", "point", "roads"]:
         cur.execute("select CreateSpatialIndex('world_%s','way')" % table)
 
-def parseFile(osmfilename, db, config, verbose=False, useCache=False):
+def collectWayNodes(osmParser, osmfilename):
+    """Do a first pass over osmfilename to find the nodes referenced by ways,
+    returns them as an IdBitSet. Only the way blocks of a PBF are read."""
+    collector = OSMPrunedNodeStore.WayNodeCollector()
+    filters = osmParser.endElementFilters
+    tagPool = osmParser.tagPool
+    osmParser.endElementFilters = []
+    osmParser.tagPool = None
+    try:
+        if OSMPBFParser and isinstance(osmParser, OSMPBFParser.OSMPBFParser):
+            osmParser.parse(osmfilename, collector, elementTypes=["way"])
+        else:
+            osmParser.parse(osmfilename, collector)
+    finally:
+        osmParser.endElementFilters = filters
+        osmParser.tagPool = tagPool
+    return collector.nodeIds
+
+def parseFile(osmfilename, db, config, verbose=False, useCache=False, workers=1, readAhead=4, flatNodes=None, sortedNodes=False, cacheFile=None, lruEntries=None, lruMB=None, prefetchNodes=0, columnStore=False, keepAllTags=False, pruneNodes=False, streamPoints=False, wayCacheMB=64, pbfIndex=None):
     if osmfilename.endswith(".osm.pbf"):
         if OSMPBFParser:
-            osmParser = OSMPBFParser.OSMPBFParser()
+            osmParser = OSMPBFParser.OSMPBFParser(workers=workers, readAhead=readAhead)
+            osmParser.indexFilename = pbfIndex
         else:
             reportError("Couldn't load PBF modules")
             return
     else:
         osmParser = OSMXMLParser.OSMXMLParser()
     
+    if flatNodes and os.path.exists(flatNodes):
+        reportError("The flat nodes file %s already exists, it would be overwritten" % flatNodes)
+        return
+    
+    if pbfIndex and OSMPBFParser and os.path.exists(pbfIndex) and not OSMPBFParser.isIndexFile(pbfIndex):
+        reportError("%s exists and isn't a PBF index, it would be overwritten" % pbfIndex)
+        return
+    
+    if useCache and cacheFile and os.path.exists(cacheFile):
+        reportError("The cache file %s already exists, it would be overwritten" % cacheFile)
+        return
+    
     if useCache:
-        datastore = OSMSQLiteStore.OSMSQLiteStore(db)
+        if cacheFile:
+            datastore = OSMSQLiteStore.OSMSQLiteStore(cacheFile, prefetch=prefetchNodes)
+        else:
+            # Put the scratch database next to the output, a leftover one
+            # from an earlier run is replaced
+            cacheFile = db.execute("PRAGMA database_list").fetchone()[2] + "-cache"
+            datastore = OSMSQLiteStore.OSMSQLiteStore(cacheFile, prefetch=prefetchNodes, overwrite=True)
     else:
         datastore = OSMMemStore.OSMMemStore()
     
+    if columnStore and not useCache:
+        if flatNodes:
+            datastore = OSMColumnStore.OSMColumnStore(OSMNodeLocationStore.FlatNodeLocations(flatNodes))
+        else:
+            datastore = OSMColumnStore.OSMColumnStore()
+    elif flatNodes:
+        datastore = OSMNodeLocationStore.OSMNodeLocationStore(datastore, OSMNodeLocationStore.FlatNodeLocations(flatNodes))
+    elif sortedNodes:
+        datastore = OSMNodeLocationStore.OSMNodeLocationStore(datastore, OSMNodeLocationStore.SortedNodeLocations())
+    
+    cachedStore = None
+    if lruEntries or lruMB:
+        datastore = cachedStore = OSMCachedStore.OSMCachedStore(datastore, maxEntries=lruEntries, maxMB=lruMB)
+    
     osmParser.reportProgress = reportDetailedProgress
+    if not useCache:
+        # Only worth it while the objects are kept in memory, the --cache
+        # store serializes the tags and the pool would just grow
+        osmParser.tagPool = OSMTagPool.TagSetPool()
+    if not keepAllTags:
+        osmParser.keepTags = configTagKeys(config)
     osmParser.reportWarning  = reportWarning
+    osmParser.filterTiming = verbose
     osmParser.reportFinished = reportEndParse
     
     reportStatus("Initialzing SQLite DB...")
@@ -562,35 +816,63 @@ def parseFile(osmfilename, db, config, verbose=False, useCache=False):
     osmParser.endElementFilters.append(ac)
     osmParser.endElementFilters.append(CopyTagValue(fromtag="layer", totag="z_order"))
     
+    pointWriter = None
+    if streamPoints:
+        pointWriter = PointWriter(db, tags)
+    
+    if pruneNodes:
+        reportStatus("Finding nodes used by ways...")
+        neededNodes = collectWayNodes(osmParser, osmfilename)
+        print len(neededNodes), "nodes used by ways"
+        datastore = OSMPrunedNodeStore.OSMPrunedNodeStore(datastore, neededNodes)
+    
+    if pointWriter:
+        # Added after the first pass, which mustn't write anything
+        osmParser.endElementFilters.append(pointWriter)
+    
     reportStatus("Parsing OSM file...")
     osmParser.parse(osmfilename, datastore)
     
+    if pointWriter:
+        pointWriter.finish()
+        print pointWriter.count, "tagged nodes written"
+    
+    if verbose:
+        for endFilter,seconds in osmParser.filterChain.getTimings():
+            print "%s: %.2fs" % (endFilter.__class__.__name__, seconds)
+    
+    if pruneNodes:
+        print datastore.dropped, "unused nodes dropped"
+    
     # write temporary memory content to database
     datastore.commit()
     
+    wayCache = None
+    if wayCacheMB:
+        wayCache = OSMWayGeometryCache.WayGeometryCache(maxMB=wayCacheMB)
+    
     #composeWays(osmParser)
-    mpolys = composeMultipolygons(datastore)
+    mpolys = composeMultipolygons(datastore, wayCache)
     
     print datastore.getNumRelations(), "relations"
     print datastore.getNumNodes(), "nodes"
     print datastore.getNumWays(), "ways"
     
+    if osmParser.tagPool is not None:
+        tagStats = osmParser.tagPool.getStats()
+        if tagStats["distinct"]:
+            print "%d tag sets, %d distinct (%.1f objects per tag set)" % (tagStats["seen"], tagStats["distinct"], tagStats["seen"] / float(tagStats["distinct"]))
+    
     print len(mpolys), "multipolygons"
-    print len(ac.areas), "areas"
+    print len(ac.areaIds), "areas"
     
     reportStatus("Writing multipolygons...")
-    writeMpolysToSQLite(db, mpolys, tags)
-    reportStatus("Writing simple areas...")
-    writeSimpleAreasToSQLite(db, datastore, ac, tags)
-    
-    # Trim areas out of the lines table
-    reportStatus("Trim areas out of the lines table...")
-    datastore.delWays([area["id"] for area in ac.areas])
-    
-    reportStatus("Writing lines...")
-    writeLinesToSQLite(db, datastore, tags)
-    reportStatus("Writing nodes...")
-    writeNodesToSQLite(db, datastore, tags)
+    writeMpolysToSQLite(db, polygonizeMultipolygons(mpolys, workers), tags)
+    reportStatus("Writing simple areas and lines...")
+    writeWaysToSQLite(db, datastore, ac.areaIds, tags, wayCache)
+    if not pointWriter:
+        reportStatus("Writing nodes...")
+        writeNodesToSQLite(db, datastore, tags)
     reportStatus("Calculating values in SQL...")
     sqlCalculateValues(db)
     reportStatus("Copying values to world_roads...")
@@ -599,6 +881,13 @@ def parseFile(osmfilename, db, config, verbose=False, useCache=False):
     sqlCreateIndexes(db)
     
     db.commit()
+    
+    if verbose and cachedStore is not None:
+        stats = cachedStore.getStats()
+        print "Lookup cache: %(hits)d hits, %(misses)d misses, %(evictions)d evictions, %(entries)d entries (~%(bytes)d bytes)" % stats
+    if verbose and wayCache is not None:
+        stats = wayCache.getStats()
+        print "Way cache: %(hits)d hits, %(misses)d misses, %(evictions)d evictions, %(entries)d entries (~%(bytes)d bytes)" % stats
     datastore.cleanup()
 
 defaultConfig = {
@@ -701,9 +990,24 @@ def main():
         print " -v, --verbose      be verbose"
         print " -c, --config       config python file to read"
         print "     --cache        cache intermediate data to disk"
+        print "     --cache-file   new scratch database for --cache (default DBFILE-cache)"
+        print "     --lru-cache    keep this many looked up objects in memory, or this"
+        print "                    much memory if it ends with MB (e.g. 500MB)"
+        print "     --prefetch     with --cache, fetch nodes in ranges of this many ids"
+        print " -j, --jobs         number of processes used to decode PBF files and build multipolygons"
+        print "     --read-ahead   number of PBF blocks to read and inflate ahead (default 4, 0 = off)"
+        print "     --flat-nodes   keep node locations in this new file, indexed by node id (deleted afterwards)"
+        print "     --sorted-nodes keep node locations in sorted in-memory arrays"
+        print "     --column-store keep data in memory in compact typed arrays"
+        print "     --keep-all-tags keep tags that aren't used by the config while parsing"
+        print "     --prune-nodes  read the ways first and drop untagged nodes no way uses"
+        print "     --pbf-index    keep the index of a PBF file's blocks in this file between"
+        print "                    runs, saves a scan of the file with --prune-nodes"
+        print "     --stream-points write tagged nodes while parsing instead of afterwards"
+        print "     --way-cache    MB of memory for composed way lines (default 64, 0 = off)"
 
     try:
-        (args, files) = getopt.getopt(sys.argv[1:], 'vc:h', ["force", "verbose", "config", "help", "cache"])
+        (args, files) = getopt.getopt(sys.argv[1:], 'vc:hj:', ["force", "verbose", "config", "help", "cache", "jobs=", "read-ahead=", "flat-nodes=", "sorted-nodes", "cache-file=", "lru-cache=", "prefetch=", "column-store", "keep-all-tags", "prune-nodes", "stream-points", "way-cache=", "pbf-index="])
     except getopt.GetoptError as ex:
         print ex
         return
@@ -732,6 +1036,50 @@ def main():
     if "--cache" in args:
         useCache = True
 
+    cacheFile = None
+    if "--cache-file" in args:
+        cacheFile = args["--cache-file"]
+
+    lruEntries = None
+    lruMB = None
+    if "--lru-cache" in args:
+        if args["--lru-cache"].upper().endswith("MB"):
+            lruMB = int(args["--lru-cache"][:-2])
+        else:
+            lruEntries = int(args["--lru-cache"])
+
+    prefetchNodes = 0
+    if "--prefetch" in args:
+        prefetchNodes = int(args["--prefetch"])
+
+    workers = 1
+    if "-j" in args:
+        workers = int(args["-j"])
+    if "--jobs" in args:
+        workers = int(args["--jobs"])
+
+    readAhead = 4
+    if "--read-ahead" in args:
+        readAhead = int(args["--read-ahead"])
+
+    flatNodes = None
+    if "--flat-nodes" in args:
+        flatNodes = args["--flat-nodes"]
+
+    sortedNodes = "--sorted-nodes" in args
+    columnStore = "--column-store" in args
+    keepAllTags = "--keep-all-tags" in args
+    pruneNodes = "--prune-nodes" in args
+    streamPoints = "--stream-points" in args
+
+    pbfIndex = None
+    if "--pbf-index" in args:
+        pbfIndex = args["--pbf-index"]
+
+    wayCacheMB = 64
+    if "--way-cache" in args:
+        wayCacheMB = int(args["--way-cache"])
+
     dbfilename = files[0]
     osmfilename = files[1]
     
@@ -744,7 +1092,7 @@ def main():
 
     if db:
         print u"Importing %s" % osmfilename
-        parseFile(osmfilename, db, config=config, verbose=verbose, useCache=useCache)
+        parseFile(osmfilename, db, config=config, verbose=verbose, useCache=useCache, workers=workers, readAhead=readAhead, flatNodes=flatNodes, sortedNodes=sortedNodes, cacheFile=cacheFile, lruEntries=lruEntries, lruMB=lruMB, prefetchNodes=prefetchNodes, columnStore=columnStore, keepAllTags=keepAllTags, pruneNodes=pruneNodes, streamPoints=streamPoints, wayCacheMB=wayCacheMB, pbfIndex=pbfIndex)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,107 @@
+#
+#  osm2spatialite
+#  Copyright (C) 2011 Daniel Sabo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os, sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import OSMObjectCodec
+from OSMObjectCodec import OSMObjectCodec as Codec
+from OSMElements import Node, Way, Member, Relation, refArray
+
+class VarintTest(unittest.TestCase):
+    def testRoundTrip(self):
+        values = [0, 1, 63, 64, 127, 128, 300, 2 ** 31, 2 ** 40, 2 ** 62]
+        for value in values + [-value for value in values]:
+            out = bytearray()
+            OSMObjectCodec.writeSigned(out, value)
+            self.assertEqual(OSMObjectCodec.readSigned(out, 0), (value, len(out)))
+            if value >= 0:
+                out = bytearray()
+                OSMObjectCodec.writeVarint(out, value)
+                self.assertEqual(OSMObjectCodec.readVarint(out, 0), (value, len(out)))
+
+    def testSmallValuesTakeOneByte(self):
+        for value in (-64, -1, 0, 63):
+            out = bytearray()
+            OSMObjectCodec.writeSigned(out, value)
+            self.assertEqual(len(out), 1)
+
+class CodecTest(unittest.TestCase):
+    def roundTripWay(self, codec, way):
+        decoded = codec.decodeWay(way.id, codec.encodeWay(way))
+        self.assertEqual(list(decoded.nodes), list(way.nodes))
+        self.assertEqual(decoded.tags, way.tags)
+        self.assertEqual(decoded.version, way.version)
+        return decoded
+
+    def testWayDeltas(self):
+        # Negative deltas, deltas at the edges of the one byte range and huge ones
+        refs = [5, 4, 67, 131, 67, 2, -56, 2 ** 33, 3, 3, 2 ** 40 + 7, 1]
+        self.roundTripWay(Codec(), Way(7, refArray(refs), {"highway":"residential"}, 3))
+        self.roundTripWay(Codec(), Way(8, refArray([]), {}))
+
+    def testStrings(self):
+        codec = Codec()
+        tags = {
+            "name":u"Stra\xdfe",  # short non-ASCII, goes in the table
+            "name:ru":u"\u0443\u043b\u0438\u0446\u0430 " * 10,  # long non-ASCII, inline
+            "note":"a long ASCII string that is stored inline instead",
+            "empty":"",
+            }
+        decoded = self.roundTripWay(codec, Way(1, refArray([1, 2]), tags))
+        self.assertTrue(isinstance(decoded.tags["note"], str))
+        self.assertTrue(isinstance(decoded.tags["name:ru"], unicode))
+        self.assertTrue(tags["note"] not in codec.stringIndex)
+        # A second object reuses the table
+        self.roundTripWay(codec, Way(2, refArray([3]), {"name":u"Stra\xdfe"}))
+        self.assertEqual(codec.strings.count(u"Stra\xdfe"), 1)
+
+    def testFullStringTable(self):
+        codec = Codec(maxStrings=3)
+        tags = dict(("k%d" % i, "v%d" % i) for i in range(10))
+        self.roundTripWay(codec, Way(1, refArray([1]), tags))
+        self.assertEqual(len(codec.strings), 3)
+        # Strings already in the table still decode after it filled up
+        self.roundTripWay(codec, Way(2, refArray([1]), tags))
+
+    def testNode(self):
+        codec = Codec()
+        for tags in ({}, {"amenity":"cafe", "name":u"Caf\xe9"}):
+            node = Node(5, (-122.4194155, 37.7749295), tags, 2)
+            data = codec.encodeNode(node)
+            decoded = codec.decodeNode(5, data)
+            self.assertEqual(decoded.point, node.point)
+            self.assertEqual(decoded.tags, tags)
+            self.assertEqual(decoded.version, 2)
+            self.assertEqual(codec.decodeNodePoint(data), list(node.point))
+
+    def testRelation(self):
+        codec = Codec()
+        members = [Member("way", 2 ** 35, "outer"), Member("way", 10, "inner"),
+                   Member("node", 11, ""), Member("relation", 3, u"r\xf4le")]
+        relation = Relation(9, members, {"type":"multipolygon"}, 1)
+        decoded = codec.decodeRelation(9, codec.encodeRelation(relation))
+        self.assertEqual([(m.type, m.ref, m.role) for m in decoded.members],
+                         [(m.type, m.ref, m.role) for m in members])
+        self.assertEqual(decoded.tags, relation.tags)
+        self.assertEqual(decoded.version, 1)
+
+if __name__ == "__main__":
+    unittest.main()
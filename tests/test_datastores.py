@@ -0,0 +1,89 @@
+#
+#  osm2spatialite
+#  Copyright (C) 2011 Daniel Sabo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os, sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import OSMMemStore, OSMSQLiteStore, OSMColumnStore, OSMNodeLocationStore, OSMCachedStore
+from OSMElements import Node, Way, Member, Relation, refArray
+
+def fill(datastore):
+    """One of each element type, ids 1 and 2 of each type are missing"""
+    datastore.addNode(Node(10, (1.5, -2.25), {"name":"a"}))
+    datastore.addWay(Way(10, refArray([10, 1]), {"highway":"road"}))
+    datastore.addRelation(Relation(10, [Member("way", 10, "outer"), Member("way", 1, "outer")], {"type":"multipolygon"}))
+    datastore.commit()
+    return datastore
+
+class BatchLookupTest(unittest.TestCase):
+    """getNodes/getWays/getRelations leave missing ids out of their result"""
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.datastores = [
+            OSMMemStore.OSMMemStore(),
+            OSMColumnStore.OSMColumnStore(),
+            OSMNodeLocationStore.OSMNodeLocationStore(OSMMemStore.OSMMemStore(), OSMNodeLocationStore.SortedNodeLocations()),
+            OSMSQLiteStore.OSMSQLiteStore(os.path.join(self.tempdir, "cache.db")),
+            OSMCachedStore.OSMCachedStore(OSMMemStore.OSMMemStore(), maxMB=1),
+            OSMCachedStore.OSMCachedStore(OSMMemStore.OSMMemStore(), maxEntries=10),
+            ]
+        for datastore in self.datastores:
+            fill(datastore)
+
+    def tearDown(self):
+        for datastore in self.datastores:
+            datastore.cleanup()
+        os.rmdir(self.tempdir)
+
+    def testMissingIdsAreLeftOut(self):
+        for datastore in self.datastores:
+            name = datastore.__class__.__name__
+            self.assertEqual(datastore.getNodes([1, 10, 2]).keys(), [10], name)
+            self.assertEqual(datastore.getWays([1, 10, 2]).keys(), [10], name)
+            self.assertEqual(datastore.getRelations([1, 10, 2]).keys(), [10], name)
+            self.assertEqual(datastore.getWays([1, 2]), {}, name)
+
+    def testSingleLookupReturnsNone(self):
+        for datastore in self.datastores:
+            name = datastore.__class__.__name__
+            self.assertEqual(datastore.getNode(1), None, name)
+            self.assertEqual(datastore.getWay(1), None, name)
+            self.assertEqual(datastore.getRelation(1), None, name)
+
+class NoneReturningStore(OSMMemStore.OSMMemStore):
+    """A datastore that maps missing ids to None in its batch lookups"""
+    def _getSet(self, osm_ids, func):
+        return dict((osm_id, func(osm_id)) for osm_id in osm_ids)
+
+class CachedStoreTest(unittest.TestCase):
+    def testMissingMemberWay(self):
+        # A multipolygon with a member way outside the extract
+        for datastore in (OSMMemStore.OSMMemStore(), NoneReturningStore()):
+            cached = OSMCachedStore.OSMCachedStore(fill(datastore), maxMB=1)
+            relation = cached.getRelation(10)
+            ways = cached.getWays([member.ref for member in relation.members])
+            self.assertEqual(ways.keys(), [10])
+            # Looking them up again is served from the cache
+            self.assertEqual(cached.getWays([10, 1]).keys(), [10])
+            self.assertEqual(cached.getStats()["entries"], 2)
+
+if __name__ == "__main__":
+    unittest.main()
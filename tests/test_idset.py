@@ -0,0 +1,65 @@
+#
+#  osm2spatialite
+#  Copyright (C) 2011 Daniel Sabo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os, sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import OSMIdSet
+from OSMIdSet import IdBitSet
+
+class IdBitSetTest(unittest.TestCase):
+    def setUp(self):
+        self.numpy = OSMIdSet.numpy
+
+    def tearDown(self):
+        OSMIdSet.numpy = self.numpy
+
+    def check(self):
+        rnd = random.Random(1)
+        # Ids around chunk boundaries, big ids and duplicates
+        ids = [0, 1, 65535, 65536, 65537, 2 ** 33, 2 ** 33 + 1]
+        ids += [rnd.randrange(0, 2 ** 20) for i in range(500)]
+        ids += ids[:50]
+        idset = IdBitSet()
+        idset.addMany(ids[:300])
+        for osm_id in ids[300:400]:
+            idset.add(osm_id)
+        idset.addMany(ids[400:410])
+        idset.addMany(ids[410:])
+        self.assertEqual(len(idset), len(set(ids)))
+
+        queries = ids + [2, 65538, 2 ** 33 + 2, 2 ** 40]
+        expected = [osm_id in set(ids) for osm_id in queries]
+        self.assertEqual([osm_id in idset for osm_id in queries], expected)
+        self.assertEqual(list(idset.containsMany(queries)), expected)
+        self.assertEqual(list(idset.containsMany(queries[-10:])), expected[-10:])
+
+    def testWithNumpy(self):
+        if OSMIdSet.numpy is None:
+            return
+        self.check()
+
+    def testWithoutNumpy(self):
+        OSMIdSet.numpy = None
+        self.check()
+
+if __name__ == "__main__":
+    unittest.main()
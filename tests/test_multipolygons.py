@@ -0,0 +1,75 @@
+#
+#  osm2spatialite
+#  Copyright (C) 2011 Daniel Sabo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os, sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import osm2spatialite
+import OSMMemStore, OSMNodeLocationStore, OSMWayGeometryCache
+from OSMElements import Node, Way, Member, Relation, refArray
+
+class ComposeMultipolygonsTest(unittest.TestCase):
+    def setUp(self):
+        self.warnings = []
+        self.reportWarning = osm2spatialite.reportWarning
+        osm2spatialite.reportWarning = self.warnings.append
+
+    def tearDown(self):
+        osm2spatialite.reportWarning = self.reportWarning
+
+    def triangle(self, datastore):
+        """A triangle relation made of three ways, the members out of order"""
+        for i,point in enumerate([(0.0, 0.0), (1.0, 0.0), (0.0, 1.0)]):
+            datastore.addNode(Node(i + 1, point, {}))
+        datastore.addWay(Way(1, refArray([1, 2]), {}))
+        datastore.addWay(Way(2, refArray([2, 3]), {}))
+        datastore.addWay(Way(3, refArray([3, 1]), {}))
+        members = [Member("way", 2, "outer"), Member("way", 3, "outer"), Member("way", 1, "outer")]
+        datastore.addRelation(Relation(1, members, {"type":"multipolygon"}))
+        datastore.commit()
+        return datastore
+
+    def assertTriangle(self, mpolys):
+        self.assertEqual(len(mpolys), 1)
+        relation,rings = mpolys[0]
+        self.assertEqual(relation.id, 1)
+        self.assertEqual([[tuple(point) for point in ring] for ring in rings],
+                         [[(0.0, 0.0), (0.0, 1.0), (1.0, 0.0), (0.0, 0.0)]])
+        self.assertEqual(self.warnings, [])
+
+    def testWithoutCache(self):
+        datastore = self.triangle(OSMMemStore.OSMMemStore())
+        self.assertTriangle(osm2spatialite.composeMultipolygons(datastore))
+
+    def testMixedCachedAndUncachedWays(self):
+        # A cache too small for all the member ways, so rings mix cached
+        # and freshly composed lines
+        for locations in (None, OSMNodeLocationStore.SortedNodeLocations()):
+            self.warnings = []
+            osm2spatialite.reportWarning = self.warnings.append
+            datastore = OSMMemStore.OSMMemStore()
+            if locations is not None:
+                datastore = OSMNodeLocationStore.OSMNodeLocationStore(datastore, locations)
+            datastore = self.triangle(datastore)
+            wayCache = OSMWayGeometryCache.WayGeometryCache(maxEntries=2)
+            self.assertTriangle(osm2spatialite.composeMultipolygons(datastore, wayCache))
+
+if __name__ == "__main__":
+    unittest.main()
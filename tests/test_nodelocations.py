@@ -0,0 +1,100 @@
+#
+#  osm2spatialite
+#  Copyright (C) 2011 Daniel Sabo
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os, sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import OSMNodeLocationStore
+from OSMNodeLocationStore import FlatNodeLocations, SortedNodeLocations
+
+def point(osm_id):
+    """Some coordinates for a node, including negative ones"""
+    return (((osm_id * 7919) % 3600000) / 10000.0 - 180.0, ((osm_id * 104729) % 1800000) / 10000.0 - 90.0)
+
+class LocationsTest(unittest.TestCase):
+    def setUp(self):
+        self.numpy = OSMNodeLocationStore.numpy
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        OSMNodeLocationStore.numpy = self.numpy
+        os.rmdir(self.tempdir)
+
+    def check(self, locations):
+        # Out of order single nodes, then blocks as lists
+        ids = [50, 3, 2 ** 20 + 1, 7]
+        for osm_id in ids:
+            locations.set(osm_id, *point(osm_id))
+        block = range(1000, 1100) + range(100, 140)
+        locations.setBlock(block, [point(i)[0] for i in block], [point(i)[1] for i in block])
+        if OSMNodeLocationStore.numpy is not None:
+            numpy = OSMNodeLocationStore.numpy
+            block2 = numpy.arange(5000, 5040)
+            locations.setBlock(block2, numpy.array([point(i)[0] for i in block2.tolist()]), numpy.array([point(i)[1] for i in block2.tolist()]))
+            ids += block2.tolist()
+        ids += block
+        self.assertEqual(len(locations), len(ids))
+
+        def expected(osm_id):
+            if osm_id not in ids:
+                return None
+            return [round(value, 7) for value in point(osm_id)]
+        def rounded(found):
+            if found is None:
+                return None
+            return [round(value, 7) for value in found]
+
+        queries = ids + [0, 4, 99, 2 ** 20, 2 ** 21]
+        for osm_id in queries:
+            self.assertEqual(rounded(locations.get(osm_id)), expected(osm_id))
+        # Long lookups take the NumPy path, short ones don't
+        self.assertEqual([rounded(p) for p in locations.getMany(queries)], [expected(i) for i in queries])
+        self.assertEqual([rounded(p) for p in locations.getMany(queries[:5])], [expected(i) for i in queries[:5]])
+
+    def testSorted(self):
+        self.check(SortedNodeLocations())
+
+    def testSortedWithoutNumpy(self):
+        OSMNodeLocationStore.numpy = None
+        self.check(SortedNodeLocations())
+
+    def testFlat(self):
+        filename = os.path.join(self.tempdir, "nodes.flat")
+        locations = FlatNodeLocations(filename)
+        try:
+            self.check(locations)
+        finally:
+            locations.close()
+        self.assertFalse(os.path.exists(filename))
+
+    def testFlatRefusesExistingFile(self):
+        filename = os.path.join(self.tempdir, "precious")
+        f = open(filename, "w")
+        f.write("data")
+        f.close()
+        try:
+            self.assertRaises(OSError, FlatNodeLocations, filename)
+            self.assertEqual(open(filename).read(), "data")
+        finally:
+            os.unlink(filename)
+
+if __name__ == "__main__":
+    unittest.main()